@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare slice compression codecs, results are printed as JSON.
+
+    python -m benchmarks.codecs --entries 100000
+    python -m benchmarks.codecs --slices /path/to/store/*/* --train dict.bin
+
+Entries are synthetic unless slice files (e.g. of a `LocalOplogStore`) are
+given. With `--train`, the zstd dictionary trained on them is saved, to be
+used as `zstd_dict_path`.
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+from benchmarks.run import setup_config, timed
+from benchmarks.generator import OplogGenerator
+
+CANDIDATES = [
+    ('lz4-block', None),
+    ('lz4-frame', None),
+    ('lz4-frame', 9),
+    ('zstd', 1),
+    ('zstd', 3),
+    ('zstd', 9),
+    ('zstd-dict', 3),
+]
+
+
+def load_entries(paths):
+    from mongo_sync.mongo_store import serializer
+
+    entries = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            entries.extend(serializer.deserialize(f.read()))
+    return entries
+
+
+def bench_codec(codec, body, repeat):
+    compress_secs, data = timed(lambda: codec.compress(body), repeat)
+    decompress_secs, _ = timed(lambda: codec.decompress(data), repeat)
+    return {
+        'codec': codec.id,
+        'level': codec.level,
+        'raw_bytes': len(body),
+        'compressed_bytes': len(data),
+        'compression_ratio': len(body) / len(data),
+        'compress_mb_per_sec': len(body) / compress_secs / 2 ** 20,
+        'decompress_mb_per_sec': len(body) / decompress_secs / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--slices', nargs='*', default=None,
+                        help='slice files to sample entries from')
+    parser.add_argument('--slice-entries', type=int, default=10000,
+                        help='entries per compressed payload')
+    parser.add_argument('--dict-size', type=int, default=112640)
+    parser.add_argument('--train', default=None,
+                        help='save the trained zstd dictionary here')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None)
+    options = parser.parse_args()
+
+    setup_config(tempfile.mkdtemp(prefix='mongo_sync_bench_'), None)
+
+    from mongo_sync import codecs
+    from mongo_sync.mongo_store import RawBSONSerializer
+
+    if options.slices:
+        entries = load_entries(options.slices)
+    else:
+        entries = OplogGenerator().generate(options.entries)
+    raw = [RawBSONSerializer.raw(e) for e in entries]
+
+    # train on the first half, measure on the second
+    half = len(raw) // 2
+    dict_data = b''
+    if codecs.zstandard is not None:
+        dict_data = codecs.train_dictionary(raw[:half], options.dict_size)
+        if options.train:
+            dict_path = options.train
+        else:
+            fd, dict_path = tempfile.mkstemp(suffix='.zstd_dict')
+            os.close(fd)
+        try:
+            with open(dict_path, 'wb') as f:
+                f.write(dict_data)
+            codecs.load_dictionary(dict_path)
+        finally:
+            if not options.train:
+                os.remove(dict_path)
+    elif options.train:
+        parser.error('--train requires zstandard')
+
+    body = b''.join(raw[half:half + options.slice_entries])
+
+    results = []
+    for codec_id, level in CANDIDATES:
+        try:
+            codec = codecs.get_codec(codec_id, level=level)
+        except ImportError as e:
+            results.append({'codec': codec_id, 'level': level,
+                            'error': str(e)})
+            continue
+        results.append(bench_codec(codec, body, options.repeat))
+
+    report = {
+        'meta': {'params': vars(options), 'entries': len(entries),
+                 'dict_bytes': len(dict_data)},
+        'results': results,
+    }
+    out = json.dumps(report, indent=2, default=str)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(out)
+    else:
+        sys.stdout.write(out + '\n')
+
+
+if __name__ == '__main__':
+    main()
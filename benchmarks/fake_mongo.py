@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process stand-in for a target `pymongo.MongoClient`, simulating one
+network round trip per request. With `record`, requests are also kept in
+`calls` as `(method, ns or db name, argument)`, in the order applied.
+Indexes listed by `index_information` are set per ns in `indexes`.
+"""
+
+import time
+import threading
+
+
+class FakeClient(object):
+
+    def __init__(self, rtt=0.0002, record=False):
+        self.rtt = rtt
+        self.record = record
+        self.round_trips = 0
+        self.requests = 0
+        self.calls = []
+        # collection names per database, as written to
+        self.collections = {}
+        self.indexes = {}
+        self._lock = threading.Lock()
+        self.admin = FakeDatabase(self, 'admin')
+
+    def _request(self, call, num_requests=1):
+        if self.rtt:
+            time.sleep(self.rtt)
+        with self._lock:
+            self.round_trips += 1
+            self.requests += num_requests
+            if self.record:
+                self.calls.append(call)
+
+    def __getitem__(self, db_name):
+        return FakeDatabase(self, db_name)
+
+    def drop_database(self, db_name):
+        self._request(('drop_database', db_name, None))
+        with self._lock:
+            self.collections.pop(db_name, None)
+
+
+class FakeDatabase(object):
+
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+
+    def __getitem__(self, coll_name):
+        return FakeCollection(self._client, self.name, coll_name)
+
+    def command(self, command, *args, **kwargs):
+        self._client._request(('command', self.name, command))
+        return {'ok': 1, 'value': None}
+
+    def list_collection_names(self):
+        with self._client._lock:
+            return sorted(self._client.collections.get(self.name, ()))
+
+    def drop_collection(self, coll_name):
+        self._client._request(
+            ('drop_collection', '{}.{}'.format(self.name, coll_name), None))
+        with self._client._lock:
+            self._client.collections.get(self.name, set()).discard(coll_name)
+
+
+class FakeCollection(object):
+
+    def __init__(self, client, db_name, coll_name):
+        self._client = client
+        self._db_name = db_name
+        self._coll_name = coll_name
+        self.ns = '{}.{}'.format(db_name, coll_name)
+
+    def _write(self, method, arg, num_requests=1):
+        self._client._request((method, self.ns, arg), num_requests)
+        with self._client._lock:
+            self._client.collections.setdefault(
+                self._db_name, set()).add(self._coll_name)
+
+    def index_information(self):
+        self._client._request(('index_information', self.ns, None))
+        return dict(self._client.indexes.get(self.ns, {}),
+                    _id_={'key': [('_id', 1)]})
+
+    def replace_one(self, filter, replacement, upsert=False):
+        self._write('replace_one', filter)
+
+    def delete_one(self, filter):
+        self._write('delete_one', filter)
+
+    def bulk_write(self, requests, ordered=True):
+        self._write('bulk_write', list(requests), len(requests))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import random
+import string
+import itertools
+
+from bson import Timestamp
+
+
+class OplogGenerator(object):
+    """
+    Generate synthetic oplog entries.
+
+    Parameters
+    ----------
+    op_mix: dict
+        relative weights of `i`, `u`, `d` and `c` ops
+    doc_size: int
+        approximate payload bytes of inserted documents
+    num_namespaces: int
+        number of collections written to
+    num_keys: int
+        number of distinct `_id`s per namespace
+    skew: float
+        zipf exponent of key popularity, 0 for uniform
+    """
+
+    def __init__(self, op_mix=None, doc_size=256, num_namespaces=10,
+                 num_keys=10000, skew=1.1, seed=0, start_time=1546300800):
+        self.op_mix = op_mix or {'i': 0.3, 'u': 0.6, 'd': 0.1}
+        self.doc_size = doc_size
+        self.namespaces = ['bench_db.coll_{}'.format(i)
+                           for i in range(num_namespaces)]
+        self.num_keys = num_keys
+        self.skew = skew
+        self.start_time = start_time
+
+        self._random = random.Random(seed)
+        self._ops = list(self.op_mix)
+        self._op_weights = list(itertools.accumulate(
+            self.op_mix[op] for op in self._ops))
+        self._key_weights = list(itertools.accumulate(
+            1.0 / (k + 1) ** skew for k in range(num_keys)))
+
+    def _payload(self, size):
+        return ''.join(self._random.choices(string.ascii_letters, k=size))
+
+    def _key(self):
+        return self._random.choices(
+            range(self.num_keys), cum_weights=self._key_weights)[0]
+
+    def entry(self, n):
+        op = self._random.choices(self._ops, cum_weights=self._op_weights)[0]
+        ns = self._random.choice(self.namespaces)
+        ts = Timestamp(self.start_time + n // 1000, n % 1000 + 1)
+        entry = {'ts': ts, 'v': 2, 'op': op, 'ns': ns}
+
+        if op == 'i':
+            entry['o'] = {'_id': self._key(), 'n': n,
+                          'payload': self._payload(self.doc_size)}
+        elif op == 'u':
+            entry['o2'] = {'_id': self._key()}
+            entry['o'] = {'$v': 1, '$set': {
+                'n': n, 'field_{}'.format(n % 8): self._payload(16)}}
+        elif op == 'd':
+            entry['o'] = {'_id': self._key()}
+        else:
+            db_name = ns.split('.', 1)[0]
+            entry['ns'] = '{}.$cmd'.format(db_name)
+            entry['o'] = {'create': 'tmp_{}'.format(n)}
+        return entry
+
+    def generate(self, num_entries, offset=0):
+        return [self.entry(n) for n in range(offset, offset + num_entries)]
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline mongo-sync benchmarks, results are printed as JSON.
+
+    python -m benchmarks.run --entries 100000 --output results.json
+
+Replay runs against an in-process stand-in unless `--dst-url` points to a
+throwaway mongod, which would be written to.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+
+import yaml
+
+from benchmarks.generator import OplogGenerator
+from benchmarks.fake_mongo import FakeClient
+
+
+def setup_config(workdir, dst_url):
+    """
+    `mongo_sync` reads its config on import, point it to a local store
+    """
+    conf = {
+        'src_url': '',
+        'dst_url': dst_url or '',
+        'oplog_store_type': 'LocalOplogStore',
+        'oplog_store_url': '',
+        'oplog_store_db': '__oplog_store',
+        'local_store_path': os.path.join(workdir, 'store'),
+        'local_store_fsync': False,
+        'whitelist': [],
+        'blacklist': [],
+        'keep_days': 7,
+        'logging': {'version': 1, 'disable_existing_loggers': False},
+    }
+    path = os.path.join(workdir, 'bench_config.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(conf, f)
+    os.environ['MONGOSYNC_CONF'] = path
+
+
+def timed(func, repeat=1):
+    best = None
+    for _ in range(repeat):
+        t0_ = time.perf_counter()
+        ret = func()
+        elapsed = time.perf_counter() - t0_
+        best = elapsed if best is None else min(best, elapsed)
+    return best, ret
+
+
+def bench_serializer(entries, fmt, repeat):
+    from mongo_sync.mongo_store import encode_slice, serializer
+    from mongo_sync.utils import entry_size
+
+    raw_bytes = sum(entry_size(e) for e in entries)
+    encode_secs, data = timed(lambda: encode_slice(fmt, entries), repeat)
+    decode_secs, _ = timed(lambda: serializer.deserialize(data), repeat)
+
+    return {
+        'name': 'serializer',
+        'format': fmt,
+        'entries': len(entries),
+        'raw_bytes': raw_bytes,
+        'encoded_bytes': len(data),
+        'compression_ratio': raw_bytes / len(data),
+        'encode_secs': encode_secs,
+        'decode_secs': decode_secs,
+        'encode_mb_per_sec': raw_bytes / encode_secs / 2 ** 20,
+        'decode_mb_per_sec': raw_bytes / decode_secs / 2 ** 20,
+    }
+
+
+def bench_local_store(entries, fmt, num_slices):
+    from bson import Timestamp
+    from mongo_sync.mongo_store import encode_slice
+    from mongo_sync.store import LocalOplogStore
+    from mongo_sync.utils import slice_name_to_ts
+
+    store = LocalOplogStore()
+    size = max(len(entries) // num_slices, 1)
+    slices = [entries[i:i + size] for i in range(0, len(entries), size)]
+    encoded = [encode_slice(fmt, s) for s in slices]
+
+    def write():
+        for s, data in zip(slices, encoded):
+            store.put_slice(s[-1]['ts'], data, s[0]['ts'], len(s))
+
+    def read():
+        ts = Timestamp(0, 0)
+        count = 0
+        while True:
+            name = store.next_slice_name(ts)
+            if name is None:
+                return count
+            count += len(store.decode(store.fetch(name)))
+            ts = slice_name_to_ts(name)
+
+    def stream():
+        count = 0
+        for name in store.list_names():
+            count += sum(1 for _ in store.stream(name))
+        return count
+
+    write_secs, _ = timed(write)
+    read_secs, _ = timed(read)
+    stream_secs, _ = timed(stream)
+    store.remove_many(store.list_names())
+
+    num_bytes = sum(len(d) for d in encoded)
+    return {
+        'name': 'local_store',
+        'format': fmt,
+        'slices': len(slices),
+        'entries': len(entries),
+        'bytes': num_bytes,
+        'write_secs': write_secs,
+        'read_secs': read_secs,
+        'stream_secs': stream_secs,
+        'write_mb_per_sec': num_bytes / write_secs / 2 ** 20,
+        'read_entries_per_sec': len(entries) / read_secs,
+        'stream_entries_per_sec': len(entries) / stream_secs,
+    }
+
+
+def bench_compaction(entries, num_slices, unique):
+    """
+    Entries left by compacting slices, `unique` collections being ordered
+    by a unique secondary index on all or none of them
+    """
+    from mongo_sync.compaction import compact, UniqueIndexes
+
+    client = FakeClient(rtt=0)
+    if unique:
+        for entry in entries:
+            client.indexes[entry['ns']] = {'k_1': {'unique': True}}
+    unique_indexes = UniqueIndexes(client)
+
+    size = max(len(entries) // num_slices, 1)
+    slices = [entries[i:i + size] for i in range(0, len(entries), size)]
+
+    secs, compacted = timed(lambda: sum(
+        len(compact(s, unique_indexes)) for s in slices))
+
+    return {
+        'name': 'compaction',
+        'unique_indexes': unique,
+        'slices': len(slices),
+        'entries': len(entries),
+        'compacted_entries': compacted,
+        'ratio': compacted / len(entries),
+        'secs': secs,
+    }
+
+
+def bench_replay(entries, engine, dst_url, rtt, workers):
+    import pymongo
+    from mongo_sync.oplog_replay import (DocManager, BulkDocManager,
+                                         PartitionedApplier)
+
+    if dst_url:
+        client = pymongo.MongoClient(dst_url)
+    else:
+        client = FakeClient(rtt=rtt)
+
+    if engine == 'per_entry':
+        docman = DocManager(client=client)
+    elif engine == 'bulk':
+        docman = BulkDocManager(client=client)
+    else:
+        docman = PartitionedApplier(
+            workers, lambda: BulkDocManager(client=client))
+
+    def apply():
+        for entry in entries:
+            docman.process(entry)
+        docman.flush()
+
+    secs, _ = timed(apply)
+    docman.close()
+
+    return {
+        'name': 'replay',
+        'engine': engine,
+        'target': 'mongod' if dst_url else 'in-process',
+        'entries': len(entries),
+        'secs': secs,
+        'ops_per_sec': len(entries) / secs,
+        'stats': docman.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--doc-size', type=int, default=256)
+    parser.add_argument('--namespaces', type=int, default=10)
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--op-mix', default='i=0.3,u=0.6,d=0.1',
+                        help='relative weights of ops, e.g. i=1,u=2,d=1,c=0')
+    parser.add_argument('--slices', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dst-url', default=None,
+                        help='throwaway mongod to replay into')
+    parser.add_argument('--rtt-ms', type=float, default=0.2,
+                        help='simulated round trip of the in-process target')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', default=None)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mongo_sync_bench_')
+    setup_config(workdir, options.dst_url)
+
+    op_mix = {k: float(v) for k, v in (
+        kv.split('=') for kv in options.op_mix.split(','))}
+    gen = OplogGenerator(op_mix=op_mix, doc_size=options.doc_size,
+                         num_namespaces=options.namespaces,
+                         num_keys=options.keys, skew=options.skew)
+    entries = gen.generate(options.entries)
+
+    results = []
+    for fmt in ('pickle', 'raw_bson'):
+        results.append(bench_serializer(entries, fmt, options.repeat))
+        results.append(bench_local_store(entries, fmt, options.slices))
+    for unique in (True, False):
+        results.append(bench_compaction(entries, options.slices, unique))
+    for engine in ('per_entry', 'bulk', 'parallel'):
+        results.append(bench_replay(entries, engine, options.dst_url,
+                                    options.rtt_ms / 1000, options.workers))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'params': vars(options),
+        },
+        'results': results,
+    }
+
+    out = json.dumps(report, indent=2, default=str)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(out)
+    else:
+        sys.stdout.write(out + '\n')
+
+
+if __name__ == '__main__':
+    main()
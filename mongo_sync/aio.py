@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio engine, chosen with `--engine asyncio`
+
+Capture and apply go through pymongo's asyncio client on one event loop, store I/O, encoding
+and decoding run in the loop's default thread pool. Each stage is bounded:
+
+    aio_encode_concurrency  slices encoded at once when dumping
+    aio_pending_slices      slices captured but not yet uploaded
+    aio_fetch_concurrency   slices fetched and decoded at once when replaying
+    aio_prefetch_slices     decoded slices waiting to be applied
+    aio_apply_concurrency   partitions writing to the target at once
+
+SIGINT/SIGTERM stop capture or apply, wait for in-flight uploads or writes
+and checkpoint before exiting.
+"""
+
+import asyncio
+import signal
+import time
+import logging
+
+import pymongo
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    AsyncMongoClient = None
+
+from mongo_sync.utils import entry_size, ts2localtime, slice_name_to_ts
+from mongo_sync.metrics import (CAPTURE_LAG, REPLAY_LAG, SLICES, ENTRIES,
+                                SLICE_BYTES, APPLIED_OPS)
+from mongo_sync.mongo_store import encode_slice
+from mongo_sync.store import slice_format, slice_codec
+from mongo_sync.namespace import NamespaceFilter
+from mongo_sync.compaction import compact
+from mongo_sync.oplog_dump import OplogDump
+from mongo_sync.oplog_replay import OplogReplay, command_calls, partition_of
+from mongo_sync.config import conf
+
+DUMP_LOG = logging.getLogger('oplog_dump')
+LOG = logging.getLogger('oplog_replay')
+
+
+def _require_async_client():
+    if AsyncMongoClient is None:
+        raise ImportError('pymongo>=4.13 is required for the asyncio engine')
+
+
+def _add_signal_handlers(callback):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, callback)
+
+
+def _remove_signal_handlers():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.remove_signal_handler(sig)
+
+
+async def _until(aw, stopping, watched=()):
+    """
+    Result of `aw`, None if `stopping` is set or a `watched` task finishes
+    first, whose error is raised
+    """
+    task = asyncio.ensure_future(aw)
+    stop = asyncio.ensure_future(stopping.wait())
+    done, _ = await asyncio.wait(
+        [task, stop, *watched], return_when=asyncio.FIRST_COMPLETED)
+    stop.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    for other in watched:
+        if other in done:
+            other.result()
+    return None
+
+
+class AsyncOplogDump(OplogDump):
+    """
+    Tail the oplog asynchronously and cut slices as in streaming mode. Slices
+    are encoded concurrently but uploaded in capture order, so that the
+    last saved ts never skips a slice.
+    """
+
+    def __init__(self, start=None, interval=None):
+        _require_async_client()
+        super().__init__(start, interval)
+
+        self._aclient = AsyncMongoClient(conf['src_url'])
+        self._aoplog = self._aclient['local'].get_collection(
+            'oplog.rs', codec_options=self._oplog.codec_options)
+
+        self._encode_concurrency = conf.get('aio_encode_concurrency', 2)
+        self._pending_slices = conf.get('aio_pending_slices', 4)
+
+        self._stopping = None
+        self._last_upload = None
+
+    def _encode(self, sliced):
+        if self._compact:
+            sliced = compact(sliced, self._unique_indexes)
+        data = encode_slice(slice_format, sliced, slice_codec)
+        return data, sliced[0]['ts'], len(sliced)
+
+    async def _upload(self, sliced, last_ts, prev):
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._encode_sem:
+                data, start_ts, count = await loop.run_in_executor(
+                    None, self._encode, sliced)
+            if prev is not None:
+                await prev
+            with self._timer.time('upload'):
+                await loop.run_in_executor(
+                    None, self._oplog_store.put_slice,
+                    last_ts, data, start_ts, count)
+        finally:
+            self._pending.release()
+
+    async def submit(self, sliced, num_bytes):
+        prev = self._last_upload
+        if prev is not None and prev.done() and prev.exception():
+            raise prev.exception()
+
+        await self._pending.acquire()
+        self._last_ts = sliced[-1]['ts']
+        self._last_upload = asyncio.ensure_future(
+            self._upload(sliced, self._last_ts, prev))
+
+        SLICES.inc(process='dump')
+        ENTRIES.inc(len(sliced), process='dump')
+        SLICE_BYTES.inc(num_bytes, kind='raw')
+
+        DUMP_LOG.info('Dumped size={}, bytes={}, ts={}'.format(
+            len(sliced), num_bytes, self._last_ts))
+
+    def open_async_stream(self):
+        query = self.oplog_query({'$gt': self._last_ts})
+        cursor = self._aoplog.find(
+            query,
+            self._projection,
+            cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+            oplog_replay=True)
+        cursor.max_await_time_ms(
+            int(min(1, self._stream_slice_seconds) * 1000))
+        DUMP_LOG.info('Opened oplog stream from ts={}'.format(self._last_ts))
+        return cursor
+
+    async def capture(self):
+        if self._last_ts is None:
+            self._last_ts = self._start_ts
+
+        cursor = None
+        sliced = []
+        num_bytes = 0
+        slice_started = None
+        probed_at = 0
+
+        while not self._stopping.is_set():
+            if cursor is None:
+                cursor = self.open_async_stream()
+
+            if time.time() - probed_at >= self._progress_interval:
+                latest = await self._aoplog.find_one(
+                    {'op': {'$ne': 'n'}}, {'ts': 1},
+                    sort=[('$natural', pymongo.DESCENDING)])
+                CAPTURE_LAG.set(latest['ts'].time - self._last_ts.time,
+                                source=self.lag_label)
+                probed_at = time.time()
+
+            try:
+                with self._timer.time('query'):
+                    entry = await cursor.next()
+            except StopAsyncIteration:
+                # a getMore came back empty, the cursor may be alive
+                entry = None
+            except (pymongo.errors.AutoReconnect,
+                    pymongo.errors.OperationFailure) as e:
+                DUMP_LOG.warning('Oplog stream broken: {}, resuming from '
+                                 'ts={}'.format(e, self._last_ts))
+                await cursor.close()
+                cursor = None
+                sliced = []
+                num_bytes = 0
+                await asyncio.sleep(1)
+                continue
+
+            if entry is not None:
+                if not sliced:
+                    slice_started = time.time()
+                sliced.append(entry)
+                if self._slice_max_bytes or hasattr(entry, 'raw'):
+                    num_bytes += entry_size(entry)
+
+            if sliced and (
+                    not cursor.alive or
+                    self.is_slice_full(len(sliced), num_bytes) or
+                    time.time() - slice_started >=
+                    self._stream_slice_seconds):
+                await self.submit(sliced, num_bytes)
+                sliced = []
+                num_bytes = 0
+
+            if not cursor.alive:
+                cursor = None
+                if entry is None:
+                    await asyncio.sleep(min(1, self._stream_slice_seconds))
+
+        if cursor is not None:
+            await cursor.close()
+        if sliced:
+            # captured entries are still saved on graceful stop
+            await self.submit(sliced, num_bytes)
+
+    async def run_async(self):
+        self._stopping = asyncio.Event()
+        self._encode_sem = asyncio.Semaphore(self._encode_concurrency)
+        self._pending = asyncio.Semaphore(self._pending_slices)
+        _add_signal_handlers(self.safe_stop)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._oplog_store.open)
+        self._running = True
+        try:
+            await self.capture()
+        except Exception as e:
+            DUMP_LOG.error(str(e), exc_info=True)
+        finally:
+            try:
+                if self._last_upload is not None:
+                    # uploads are chained, the last one waits for the rest
+                    await self._last_upload
+            except Exception as e:
+                DUMP_LOG.error(str(e), exc_info=True)
+            self._running = False
+            _remove_signal_handlers()
+            await self._aclient.close()
+            await loop.run_in_executor(None, self.close)
+
+        DUMP_LOG.warning('Oplog dumping stopped.')
+
+    def is_running(self):
+        return self._running
+
+    def start(self):
+        asyncio.run(self.run_async())
+
+    def safe_stop(self):
+        self._running = False
+        if self._stopping is not None:
+            self._stopping.set()
+        DUMP_LOG.warning('Would stop once in-flight slices are uploaded.')
+
+
+class AsyncDocManager(object):
+    """
+    Apply entries to the target through the asyncio client, see
+    `DocManager`
+    """
+
+    def __init__(self, client):
+        self.mongo = client
+
+        self._ns_filter = NamespaceFilter(
+            conf['whitelist'], conf['blacklist'],
+            cache_size=conf.get('ns_filter_cache_size', 10000))
+
+        self.num_requests = 0
+        self.num_round_trips = 0
+
+    def should_sync(self, entry):
+        return self._ns_filter.should_sync(entry['ns'])
+
+    async def process(self, entry):
+
+        if not self.should_sync(entry):
+            return
+
+        operation = entry['op']
+        APPLIED_OPS.inc(op=operation)
+
+        if operation == 'd':
+            await self.remove(entry)
+
+        elif operation == 'i':
+            await self.insert(entry)
+
+        elif operation == 'u':
+            await self.update(entry)
+
+        elif operation == 'c':
+            try:
+                await self.handle_command(entry)
+            except pymongo.errors.OperationFailure as e:
+                LOG.warning('Command failed: {}'.format(e))
+
+        self.num_requests += 1
+        self.num_round_trips += 1
+
+    def stats(self):
+        return 'requests={}, round trips={}, {}'.format(
+            self.num_requests, self.num_round_trips,
+            self._ns_filter.stats())
+
+    def _coll(self, ns):
+        db_name, coll_name = ns.split('.', 1)
+        return self.mongo[db_name][coll_name]
+
+    async def insert(self, entry):
+        doc = entry['o']
+        await self._coll(entry['ns']).replace_one(
+            {'_id': doc['_id']}, doc, upsert=True)
+
+    async def update(self, entry):
+        _id = entry['o2']['_id']
+        doc = entry['o']
+        coll = self._coll(entry['ns'])
+        if any(k.startswith('$') for k in doc):
+            await coll.update_one({'_id': _id}, doc)
+        else:
+            # full document replacement
+            await coll.replace_one({'_id': _id}, doc)
+
+    async def remove(self, entry):
+        doc = entry['o']
+        await self._coll(entry['ns']).delete_one({'_id': doc['_id']})
+
+    async def handle_command(self, entry):
+        calls = command_calls(self.mongo, entry, self._ns_filter)
+        result = None
+        while True:
+            try:
+                method, args, kwargs = calls.send(result)
+            except StopIteration:
+                return
+            result = await method(*args, **kwargs)
+
+
+class AsyncApplier(object):
+    """
+    Coroutine counterpart of `PartitionedApplier`: one worker per hash
+    partition of `(ns, _id)`, commands are barriers. Must be created
+    within the running loop.
+    """
+
+    def __init__(self, docman, concurrency, queue_size=1000):
+        self._docman = docman
+        self._num_workers = concurrency
+        self._queues = [asyncio.Queue(maxsize=queue_size)
+                        for _ in range(concurrency)]
+        self._errors = []
+        self._tasks = [asyncio.ensure_future(self._work(i, q))
+                       for i, q in enumerate(self._queues)]
+
+    async def _work(self, i, q):
+        while True:
+            entry = await q.get()
+            try:
+                # skip remaining entries once any worker failed
+                if not self._errors:
+                    await self._docman.process(entry)
+            except Exception as e:
+                LOG.error('Worker {} failed: {}'.format(i, e), exc_info=True)
+                self._errors.append(e)
+            finally:
+                q.task_done()
+
+    def _check_errors(self):
+        if self._errors:
+            raise Exception('Parallel replay failed: {}'.format(
+                self._errors[0]))
+
+    def partition(self, entry):
+        return partition_of(entry, self._num_workers)
+
+    async def process(self, entry):
+        self._check_errors()
+
+        if entry['op'] not in ('i', 'u', 'd'):
+            await self.flush()
+            await self._docman.process(entry)
+            return
+
+        await self._queues[self.partition(entry)].put(entry)
+
+    async def flush(self):
+        await asyncio.gather(*(q.join() for q in self._queues))
+        self._check_errors()
+
+    def stats(self):
+        return self._docman.stats()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class AsyncOplogReplay(OplogReplay):
+    """
+    Fetch and decode the next slices concurrently while applying the
+    current one through the asyncio client, checkpointing as `OplogReplay` does.
+    `replay_streaming`, `replay_prefetch` and the threaded doc managers
+    do not apply.
+    """
+
+    def __init__(self, start=None):
+        _require_async_client()
+        super().__init__(start)
+
+        self._fetch_concurrency = conf.get('aio_fetch_concurrency', 2)
+        self._prefetch_slices = conf.get('aio_prefetch_slices', 4)
+        self._apply_concurrency = conf.get('aio_apply_concurrency', 8)
+
+        self._stopping = None
+        self._applier = None
+
+    def make_docman(self):
+        # created within the loop, see `run_async`
+        return None
+
+    def _load(self, name):
+        with self._timer.time('fetch'):
+            data = self._oplog_store.fetch(name)
+        with self._timer.time('decode'):
+            oplog = list(self._oplog_store.decode(data))
+        if self._compact:
+            with self._timer.time('compact'):
+                oplog = compact(oplog, self._unique_indexes)
+        return oplog
+
+    async def _load_async(self, name):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._load, name)
+        finally:
+            self._fetch_sem.release()
+
+    async def read_slices(self, slices):
+        """
+        Queue `(name, task)` of the next slices in order, slice names are
+        end ts so the next slice is found before the current one is loaded
+        """
+        loop = asyncio.get_running_loop()
+        last_ts = self._last_ts
+        while not self._stopping.is_set():
+            name = await loop.run_in_executor(
+                None, self._oplog_store.next_slice_name, last_ts)
+            if name is None:
+                await _until(loop.run_in_executor(
+                    None, self._oplog_store.wait_for_slice, last_ts, 10),
+                    self._stopping)
+                continue
+
+            await loop.run_in_executor(None, self.check_filter, name)
+            last_ts = slice_name_to_ts(name)
+
+            await self._fetch_sem.acquire()
+            task = asyncio.ensure_future(self._load_async(name))
+            await slices.put((name, task))
+
+    async def checkpoint_async(self, ts):
+        loop = asyncio.get_running_loop()
+        t0_ = time.time()
+        await self._applier.flush()
+        await loop.run_in_executor(None, self.write_tag_file, ts)
+        self._timer.observe('checkpoint', time.time() - t0_)
+        self._last_checkpoint = time.time()
+
+    async def replay_async(self, oplog):
+
+        t0_ = time.time()
+        size = 0
+        pending = 0
+        last = None
+        with self._timer.time('apply'):
+            for entry in oplog:
+                if self._stopping.is_set():
+                    break
+                await self._applier.process(entry)
+                last = entry
+                size += 1
+                pending += 1
+                if (pending >= self._checkpoint_entries or
+                        time.time() - self._last_checkpoint >=
+                        self._checkpoint_seconds):
+                    await self.checkpoint_async(entry['ts'])
+                    pending = 0
+
+        if last is not None:
+            self._last_ts = last['ts']
+        await self.checkpoint_async(self._last_ts)
+        elapsed = time.time() - t0_
+
+        SLICES.inc(process='replay')
+        ENTRIES.inc(size, process='replay')
+        REPLAY_LAG.set(time.time() - self._last_ts.time,
+                       target=self.lag_label)
+
+        LOG.info('Replayed size={} in {:.3f} secs, {:.0f} ops/sec ({})'.format(
+            size, elapsed, size / max(elapsed, 1e-6), self._applier.stats()))
+        LOG.info('Current progress={}'.format(ts2localtime(self._last_ts)))
+        LOG.info('Stage timings: {}'.format(self._timer.summary()))
+
+    async def run_async(self):
+        self._stopping = asyncio.Event()
+        self._fetch_sem = asyncio.Semaphore(self._fetch_concurrency)
+        _add_signal_handlers(self.safe_stop)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._oplog_store.open)
+
+        client = AsyncMongoClient(conf['dst_url'])
+        self._applier = AsyncApplier(
+            AsyncDocManager(client), self._apply_concurrency)
+        slices = asyncio.Queue(maxsize=self._prefetch_slices)
+        reader = asyncio.ensure_future(self.read_slices(slices))
+
+        self._running = True
+        try:
+            while not self._stopping.is_set():
+                # fails as soon as the reader does
+                item = await _until(slices.get(), self._stopping, [reader])
+                if item is None:
+                    break
+                name, task = item
+                oplog = await task
+                LOG.info('Loaded {}, last progress={}'.format(
+                    name, ts2localtime(self._last_ts)))
+                await self.replay_async(self._skip_replayed(oplog))
+        except Exception as e:
+            LOG.error(str(e), exc_info=True)
+        finally:
+            reader.cancel()
+            while not slices.empty():
+                slices.get_nowait()[1].cancel()
+            try:
+                # in-flight writes are drained by the final checkpoint
+                await self.checkpoint_async(self._last_ts)
+            except Exception as e:
+                LOG.error(str(e), exc_info=True)
+            await self._applier.close()
+            self._running = False
+            _remove_signal_handlers()
+            await client.close()
+            await loop.run_in_executor(None, self._oplog_store.close)
+
+        LOG.warning('Oplog syncing stopped.')
+
+    def is_running(self):
+        return self._running
+
+    def start(self):
+        LOG.warning('Oplog syncing starting with asyncio engine...')
+        asyncio.run(self.run_async())
+
+    def safe_stop(self):
+        self._running = False
+        if self._stopping is not None:
+            self._stopping.set()
+        LOG.warning('Would stop once in-flight writes are applied.')
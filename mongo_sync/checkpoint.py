@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+
+import pymongo
+from bson import Timestamp
+
+from mongo_sync.utils import ts2localtime
+from mongo_sync.config import conf
+
+
+class FileCheckpoint(object):
+    """
+    Replay progress in a tag file of `<time>_<inc>=<local time>`, replaced
+    atomically on write
+    """
+
+    def __init__(self, path='tag_file'):
+        self.path = path
+
+    def read(self):
+        """
+        Last checkpointed ts, None if not any, -1 if left by an old version
+        that crashed mid-slice
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            tag = f.read()
+        if tag == '-1':
+            return -1
+        _time, _inc = tag.split('=')[0].split('_')
+        return Timestamp(int(_time), int(_inc))
+
+    def write(self, ts):
+        tag = '{}_{}={}'.format(ts.time, ts.inc, ts2localtime(ts))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(tag)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class MongoCheckpoint(object):
+    """
+    Replay progress in a collection of the target mongod
+    """
+
+    def __init__(self, client, db_name='__mongo_sync', coll_name='checkpoints',
+                 key='oplog_replay'):
+        self._coll = client[db_name][coll_name]
+        self.key = key
+
+    def read(self):
+        doc = self._coll.find_one({'_id': self.key})
+        if doc is None:
+            return None
+        return doc['ts']
+
+    def write(self, ts):
+        self._coll.replace_one(
+            {'_id': self.key},
+            {'ts': ts, 'updated': datetime.datetime.utcnow()},
+            upsert=True)
+
+    def clear(self):
+        self._coll.delete_one({'_id': self.key})
+
+
+def make_checkpoint(name=None, url=None):
+    """
+    Checkpoint configured by `checkpoint_store`, `name` tells apart replay
+    processes sharing the same location, `mongo` checkpoints are kept in
+    the target at `url`, `dst_url` by default
+    """
+    store = conf.get('checkpoint_store', 'file')
+    if store == 'mongo':
+        client = pymongo.MongoClient(url or conf['dst_url'])
+        key = 'oplog_replay' if name is None else 'oplog_replay.' + name
+        return MongoCheckpoint(
+            client,
+            conf.get('checkpoint_db', '__mongo_sync'),
+            conf.get('checkpoint_collection', 'checkpoints'),
+            key)
+
+    path = conf.get('checkpoint_path', 'tag_file')
+    if name is not None:
+        path = '{}.{}'.format(path, name)
+    return FileCheckpoint(path)
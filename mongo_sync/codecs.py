@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compression codecs for slices, looked up by the codec id recorded with
+each slice:
+
+    lz4-block       lz4 block, not streamable
+    lz4-frame       lz4 frame, optional level
+    zstd            zstandard, optional level
+    zstd-dict:<id>  zstandard with a dictionary trained from sample slices
+"""
+
+import lz4.block
+import lz4.frame
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_CODEC = 'lz4-frame'
+
+# zstd dictionaries by dict id, as raw bytes
+_dictionaries = {}
+_default_dictionary = None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError('zstandard is required for zstd codecs')
+
+
+def load_dictionary(path):
+    """
+    Register a zstd dictionary file, the last loaded one is used to write
+    `zstd-dict` slices
+    """
+    global _default_dictionary
+    _require_zstandard()
+    with open(path, 'rb') as f:
+        data = f.read()
+    dict_id = zstandard.ZstdCompressionDict(data).dict_id()
+    _dictionaries[dict_id] = data
+    _default_dictionary = dict_id
+    return dict_id
+
+
+def train_dictionary(samples, dict_size=112640):
+    """
+    Train a zstd dictionary from samples, e.g. raw BSON oplog entries
+    """
+    _require_zstandard()
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+class _BufferedCompressor(object):
+
+    def __init__(self, compress):
+        self._compress = compress
+        self._chunks = []
+
+    def compress(self, data):
+        self._chunks.append(data)
+        return b''
+
+    def flush(self):
+        return self._compress(b''.join(self._chunks))
+
+
+class _Lz4FrameCompressor(object):
+
+    def __init__(self, level):
+        self._compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level)
+        # the frame header goes out with the first output
+        self._header = self._compressor.begin()
+
+    def _emit(self, out):
+        if self._header:
+            out = self._header + out
+            self._header = b''
+        return out
+
+    def compress(self, data):
+        return self._emit(self._compressor.compress(data))
+
+    def flush(self):
+        return self._emit(self._compressor.flush())
+
+
+class _BufferedDecompressor(object):
+
+    def __init__(self, decompress):
+        self._decompress = decompress
+        self._chunks = []
+
+    def decompress(self, data):
+        self._chunks.append(bytes(data))
+        return b''
+
+    def flush(self):
+        return self._decompress(b''.join(self._chunks))
+
+
+class _Decompressor(object):
+
+    def __init__(self, decompress, flush=None):
+        self.decompress = decompress
+        self.flush = flush or (lambda: b'')
+
+
+class Codec(object):
+    """
+    Compress whole payloads, or incrementally through `compressor()` and
+    `decompressor()` objects
+    """
+
+    id = None
+
+    def __init__(self, level=None):
+        self.level = level
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+    def compressor(self):
+        return _BufferedCompressor(self.compress)
+
+    def decompressor(self):
+        return _BufferedDecompressor(self.decompress)
+
+
+class Lz4BlockCodec(Codec):
+
+    id = 'lz4-block'
+
+    def compress(self, data):
+        return lz4.block.compress(data, mode='fast')
+
+    def decompress(self, data):
+        return lz4.block.decompress(data)
+
+
+class Lz4FrameCodec(Codec):
+
+    id = 'lz4-frame'
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level or 0)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+    def compressor(self):
+        return _Lz4FrameCompressor(self.level or 0)
+
+    def decompressor(self):
+        return _Decompressor(lz4.frame.LZ4FrameDecompressor().decompress)
+
+
+class ZstdCodec(Codec):
+
+    id = 'zstd'
+
+    def __init__(self, level=None):
+        _require_zstandard()
+        super().__init__(level)
+
+    def _dict(self):
+        return None
+
+    def _cctx(self):
+        kwargs = {'level': self.level or 3}
+        if self._dict() is not None:
+            kwargs['dict_data'] = self._dict()
+        return zstandard.ZstdCompressor(**kwargs)
+
+    def _dctx(self):
+        if self._dict() is not None:
+            return zstandard.ZstdDecompressor(dict_data=self._dict())
+        return zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._cctx().compress(data)
+
+    def decompress(self, data):
+        # frames written by `compressor()` have no content size
+        return self._dctx().decompressobj().decompress(data)
+
+    def compressor(self):
+        return self._cctx().compressobj()
+
+    def decompressor(self):
+        return _Decompressor(self._dctx().decompressobj().decompress)
+
+
+class ZstdDictCodec(ZstdCodec):
+
+    def __init__(self, level=None, dict_id=None):
+        super().__init__(level)
+        dict_id = dict_id or _default_dictionary
+        if dict_id not in _dictionaries:
+            raise Exception('zstd dictionary {} not loaded'.format(dict_id))
+        self.dict_id = dict_id
+        self.id = 'zstd-dict:{}'.format(dict_id)
+        self._dict_data = None
+
+    def _dict(self):
+        if self._dict_data is None:
+            self._dict_data = zstandard.ZstdCompressionDict(
+                _dictionaries[self.dict_id])
+        return self._dict_data
+
+    def __getstate__(self):
+        # the dictionary object itself can not be pickled
+        state = dict(self.__dict__)
+        state['_dict_data'] = None
+        return state
+
+
+CODECS = {
+    'lz4-block': Lz4BlockCodec,
+    'lz4-frame': Lz4FrameCodec,
+    'zstd': ZstdCodec,
+    'zstd-dict': ZstdDictCodec,
+}
+
+
+def get_codec(codec_id=None, level=None):
+    """
+    Codec by id, e.g. `zstd` or `zstd-dict:<dict id>`
+    """
+    name, _, arg = (codec_id or DEFAULT_CODEC).partition(':')
+    if name not in CODECS:
+        raise Exception('Unknown slice codec {}'.format(codec_id))
+    if name == 'zstd-dict':
+        return ZstdDictCodec(level, int(arg) if arg else None)
+    return CODECS[name](level)
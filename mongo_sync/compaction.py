@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-slice oplog compaction, coalescing ops on the same document.
+
+Within a slice, consecutive ops on a document `(ns, _id)`, with no command
+and no write to another document of `ns` in between, are merged into the
+fewest equivalent writes:
+
+    * an insert (or replacement) followed by `$set`/`$unset` updates of
+      top-level fields folds into one insert (or replacement)
+    * any sequence ending in a delete becomes one delete, and an insert
+      overrides anything before it
+    * consecutive `$set`/`$unset` updates merge into one update, unless
+      their paths overlap
+
+A merged entry takes the position and ts of the last op it covers, so the
+last ts of a slice is kept. In a collection with a unique secondary index,
+it only moves past writes to other collections, so writes to the
+collection keep their order, as the index needs, e.g. for a value moved
+from one document to another. Other collections merge past writes to
+other documents too.
+"""
+
+import logging
+import threading
+
+from pymongo.errors import OperationFailure
+
+from mongo_sync.utils import get_doc_id
+
+LOG = logging.getLogger(__name__)
+
+MERGEABLE_MODIFIERS = {'$set', '$unset', '$v'}
+
+
+def _doc_key(entry):
+    _id = get_doc_id(entry)
+    try:
+        hash(_id)
+    except TypeError:
+        _id = repr(_id)
+    # 1 and 1.0 may be the same _id, they are simply not merged
+    return entry['ns'], type(_id), _id
+
+
+def _is_modifier(doc):
+    return any(k.startswith('$') for k in doc)
+
+
+def _mergeable_modifier(doc):
+    return set(doc) <= MERGEABLE_MODIFIERS
+
+
+def _paths_conflict(a, b):
+    return a != b and (a.startswith(b + '.') or b.startswith(a + '.'))
+
+
+def _entry(prev, cur, op, o):
+    entry = {'ts': cur['ts'], 'op': op, 'ns': cur['ns'], 'o': o}
+    if op == 'u':
+        entry['o2'] = {'_id': get_doc_id(prev)}
+    return entry
+
+
+def _apply_modifier(base, modifier):
+    keys = list(modifier.get('$set', {})) + list(modifier.get('$unset', {}))
+    if any('.' in k for k in keys):
+        return None
+    doc = dict(base)
+    for k, v in modifier.get('$set', {}).items():
+        doc[k] = v
+    for k in modifier.get('$unset', {}):
+        doc.pop(k, None)
+    return doc
+
+
+def _merge_modifiers(prev, cur):
+    new_set = dict(prev.get('$set', {}))
+    new_unset = dict(prev.get('$unset', {}))
+
+    old_paths = list(new_set) + list(new_unset)
+    new_paths = list(cur.get('$set', {})) + list(cur.get('$unset', {}))
+    for a in new_paths:
+        for b in old_paths:
+            if _paths_conflict(a, b):
+                return None
+
+    for k, v in cur.get('$set', {}).items():
+        new_unset.pop(k, None)
+        new_set[k] = v
+    for k, v in cur.get('$unset', {}).items():
+        new_set.pop(k, None)
+        new_unset[k] = v
+
+    doc = {}
+    if '$v' in cur:
+        doc['$v'] = cur['$v']
+    if new_set:
+        doc['$set'] = new_set
+    if new_unset:
+        doc['$unset'] = new_unset
+    return doc
+
+
+def merge(prev, cur):
+    """
+    Merge two consecutive ops on the same document, None if they can not
+    be merged
+    """
+    if cur['op'] in ('d', 'i'):
+        return cur
+
+    # update of a deleted document is a no-op
+    if prev['op'] == 'd':
+        return _entry(prev, cur, 'd', prev['o'])
+
+    doc = cur['o']
+    if not _is_modifier(doc):
+        # replacement
+        if prev['op'] == 'i':
+            doc = dict(doc)
+            doc['_id'] = get_doc_id(prev)
+            return _entry(prev, cur, 'i', doc)
+        return cur
+
+    if not _mergeable_modifier(doc):
+        return None
+
+    prev_doc = prev['o']
+    if prev['op'] == 'i' or not _is_modifier(prev_doc):
+        folded = _apply_modifier(prev_doc, doc)
+        if folded is None:
+            return None
+        return _entry(prev, cur, prev['op'], folded)
+
+    if not _mergeable_modifier(prev_doc):
+        return None
+    merged = _merge_modifiers(prev_doc, doc)
+    if merged is None:
+        return None
+    return _entry(prev, cur, 'u', merged)
+
+
+class UniqueIndexes(object):
+    """
+    Whether collections have a unique secondary index, looked up once per
+    namespace through `client`, again after a command on its database
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._unique = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, ns):
+        db_name, coll_name = ns.split('.', 1)
+        try:
+            indexes = self._client[db_name][coll_name].index_information()
+        except OperationFailure as e:
+            LOG.warning('Failed to list indexes of {}, keep its order: {}'
+                        .format(ns, e))
+            return True
+        return any(info.get('unique') for name, info in indexes.items()
+                   if name != '_id_')
+
+    def __call__(self, ns):
+        with self._lock:
+            if ns not in self._unique:
+                self._unique[ns] = self._lookup(ns)
+            return self._unique[ns]
+
+    def forget(self, db_name):
+        prefix = db_name + '.'
+        with self._lock:
+            for ns in [ns for ns in self._unique if ns.startswith(prefix)]:
+                del self._unique[ns]
+
+
+def compact(oplog, unique_indexes=None):
+    """
+    Compact a slice, return the list of merged entries. Writes to
+    different documents of a collection keep their order if
+    `unique_indexes(ns)`, or without `unique_indexes`
+    """
+    out = []
+    # per ns, key and position of the last write
+    last_of_ns = {}
+    # per key, position of the last write
+    last_of_doc = {}
+    # databases with a command in the slice, whose indexes may have changed
+    changed = set()
+
+    for entry in oplog:
+        if entry['op'] not in ('i', 'u', 'd'):
+            out.append(entry)
+            last_of_ns = {}
+            last_of_doc = {}
+            if unique_indexes is not None:
+                db_name = entry['ns'].split('.', 1)[0]
+                unique_indexes.forget(db_name)
+                changed.add(db_name)
+            continue
+
+        ns = entry['ns']
+        key = _doc_key(entry)
+        if (unique_indexes is None or ns.split('.', 1)[0] in changed or
+                unique_indexes(ns)):
+            last_key, i = last_of_ns.get(ns, (None, None))
+            if last_key != key:
+                i = None
+        else:
+            i = last_of_doc.get(key)
+
+        if i is not None:
+            merged = merge(out[i], entry)
+            if merged is not None:
+                out[i] = None
+                entry = merged
+
+        last_of_ns[ns] = key, len(out)
+        last_of_doc[key] = len(out)
+        out.append(entry)
+
+    return [e for e in out if e is not None]
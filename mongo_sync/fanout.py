@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import collections
+import logging
+
+from mongo_sync.oplog_replay import OplogReplay
+from mongo_sync.config import conf
+
+LOG = logging.getLogger('oplog_replay')
+
+
+class SliceCache(object):
+    """
+    Bounded LRU cache of decoded slices shared by replayers. A slice missed
+    by several replayers at once is loaded by the first one only.
+    """
+
+    def __init__(self, max_slices):
+        self._max_slices = max_slices
+        self._slices = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, load):
+        """
+        Decoded entries of slice `name`, loaded by `load(name)` on a miss
+        """
+        while True:
+            with self._lock:
+                if name in self._slices:
+                    self._slices.move_to_end(name)
+                    self.hits += 1
+                    return self._slices[name]
+                event = self._loading.get(name)
+                if event is None:
+                    event = self._loading[name] = threading.Event()
+                    self.misses += 1
+                    break
+            # loaded by another replayer, or failed and retried
+            event.wait()
+
+        try:
+            oplog = list(load(name))
+            with self._lock:
+                self._slices[name] = oplog
+                while len(self._slices) > self._max_slices:
+                    self._slices.popitem(last=False)
+            return oplog
+        finally:
+            with self._lock:
+                del self._loading[name]
+            event.set()
+
+    def stats(self):
+        return 'slice cache hits={}, misses={}'.format(self.hits, self.misses)
+
+
+class LagWindow(object):
+    """
+    Hold back replayers more than `seconds` of oplog time ahead of the
+    slowest running one, so that a slow target lags fast ones by a bounded
+    amount, and slices are still cached when it gets to them
+    """
+
+    def __init__(self, seconds):
+        self._seconds = seconds
+        self._replays = []
+        self._cond = threading.Condition()
+
+    def join(self, op):
+        with self._cond:
+            self._replays.append(op)
+
+    def leave(self, op):
+        with self._cond:
+            if op in self._replays:
+                self._replays.remove(op)
+            self._cond.notify_all()
+
+    def advance(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, op, ts):
+        """
+        Block `op` until it may load the slice ending at `ts`, False if it
+        was stopped meanwhile
+        """
+        logged = False
+        with self._cond:
+            while op.is_active():
+                slowest_ts = min(o.last_ts for o in self._replays)
+                if (op.last_ts <= slowest_ts or
+                        ts.time - slowest_ts.time <= self._seconds):
+                    return True
+                if not logged:
+                    LOG.info('Target {} waiting for the slowest at {}'.format(
+                        op.name, slowest_ts))
+                    logged = True
+                self._cond.wait(1)
+        return False
+
+
+class FanoutReplay(object):
+    """
+    Replay one slice stream to each of `targets`, with its own doc manager,
+    apply workers, checkpoint and thread, fetching and decoding every slice
+    once into a shared `SliceCache`
+    """
+
+    def __init__(self, targets, start=None):
+        self._cache = SliceCache(conf.get('fanout_cache_slices', 8))
+        self._window = LagWindow(conf.get('fanout_lag_window', 600))
+
+        self._replays = []
+        for target in targets:
+            op = OplogReplay(start, target=target)
+            op.slice_cache = self._cache
+            op.lag_window = self._window
+            self._window.join(op)
+            self._replays.append(op)
+
+        LOG.info('Fan-out replay to targets={}'.format(
+            [op.name for op in self._replays]))
+
+    def is_running(self):
+        # targets fail independently, the rest go on
+        return any(op.is_running() for op in self._replays)
+
+    def start(self):
+        for op in self._replays:
+            op.start()
+
+    def safe_stop(self):
+        for op in self._replays:
+            op.safe_stop()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from bson import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from mongo_sync.utils import copy_index, ts2localtime
+from mongo_sync.namespace import NamespaceFilter
+from mongo_sync.checkpoint import make_checkpoint
+from mongo_sync.config import conf
+
+LOG = logging.getLogger('initial_sync')
+
+SYSTEM_DBS = ('admin', 'local', 'config')
+
+DUPLICATE_KEY = 11000
+
+
+class InitialSync(object):
+    """
+    Clone the whitelisted collections of `src_url` into `dst_url`, then
+    checkpoint the source oplog ts read before cloning, so that replay
+    continues from there. Entries between that ts and the end of cloning
+    are applied again by replay, which is idempotent.
+
+    Each collection is split into `_id` ranges of about
+    `initial_sync_range_docs` documents, copied by `initial_sync_workers`
+    threads in unordered `insert_many` batches. Duplicate keys are ignored,
+    so an interrupted sync may simply be run again, it keeps the start ts of
+    the first attempt, as documents it copied may be older than any later
+    one. Indexes other than `_id` are built once all data is loaded.
+    """
+
+    def __init__(self):
+        self._src = pymongo.MongoClient(conf['src_url'])
+        self._dst = pymongo.MongoClient(conf['dst_url'])
+        # documents are copied as fetched, without decoding
+        self._codec_options = CodecOptions(document_class=RawBSONDocument)
+
+        self._ns_filter = NamespaceFilter(conf['whitelist'], conf['blacklist'])
+
+        self._workers = conf.get('initial_sync_workers', 8)
+        self._batch_size = conf.get('initial_sync_batch_size', 1000)
+        self._range_docs = conf.get('initial_sync_range_docs', 100000)
+
+        self._checkpoint = make_checkpoint()
+        # start ts of an unfinished sync
+        self._attempt = make_checkpoint('initial_sync')
+
+    def _src_coll(self, ns):
+        db_name, coll_name = ns.split('.', 1)
+        return self._src[db_name].get_collection(
+            coll_name, codec_options=self._codec_options)
+
+    def _index_coll(self, ns):
+        # decoded, as `copy_index` reads index specs
+        db_name, coll_name = ns.split('.', 1)
+        return self._src[db_name][coll_name]
+
+    def _dst_coll(self, ns):
+        db_name, coll_name = ns.split('.', 1)
+        return self._dst[db_name][coll_name]
+
+    def get_latest_ts(self):
+        return self._src['local']['oplog.rs'].find_one(
+            {}, {'ts': 1}, sort=[('$natural', pymongo.DESCENDING)])['ts']
+
+    def list_namespaces(self):
+        namespaces = []
+        for db_name in self._src.list_database_names():
+            if db_name in SYSTEM_DBS:
+                continue
+            # views have no data of their own
+            for coll_name in self._src[db_name].list_collection_names(
+                    filter={'type': 'collection'}):
+                if coll_name.startswith('system.'):
+                    continue
+                ns = '{}.{}'.format(db_name, coll_name)
+                if self._ns_filter.should_sync(ns):
+                    namespaces.append(ns)
+        return sorted(namespaces)
+
+    def split_ranges(self, ns):
+        """
+        `[(min_id, max_id), ...]` covering the collection, None for
+        unbounded, boundaries are taken from a server-sorted `$sample`
+        """
+        coll = self._src_coll(ns)
+        num_ranges = coll.estimated_document_count() // self._range_docs + 1
+        if num_ranges <= 1:
+            return [(None, None)]
+
+        # oversampled, for evenly sized ranges
+        samples = [doc['_id'] for doc in coll.aggregate([
+            {'$sample': {'size': num_ranges * 10}},
+            {'$project': {'_id': 1}},
+            {'$sort': {'_id': 1}}], allowDiskUse=True)]
+        if not samples:
+            return [(None, None)]
+
+        bounds = []
+        for i in range(1, num_ranges):
+            _id = samples[i * len(samples) // num_ranges]
+            if not bounds or bounds[-1] != _id:
+                bounds.append(_id)
+
+        lows = [None] + bounds
+        highs = bounds + [None]
+        return list(zip(lows, highs))
+
+    def copy_range(self, ns, min_id, max_id):
+        src_coll = self._src_coll(ns)
+        dst_coll = self._dst_coll(ns)
+
+        # index bounds rather than $gte/$lt, which only match one BSON type
+        cursor = src_coll.find(
+            {}, batch_size=self._batch_size, no_cursor_timeout=True
+        ).hint([('_id', pymongo.ASCENDING)])
+        if min_id is not None:
+            cursor = cursor.min([('_id', min_id)])
+        if max_id is not None:
+            cursor = cursor.max([('_id', max_id)])
+
+        count = 0
+        batch = []
+        try:
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= self._batch_size:
+                    count += self._insert(dst_coll, batch)
+                    batch = []
+            if batch:
+                count += self._insert(dst_coll, batch)
+        finally:
+            cursor.close()
+        return count
+
+    @staticmethod
+    def _insert(dst_coll, docs):
+        try:
+            dst_coll.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = [err for err in e.details['writeErrors']
+                      if err['code'] != DUPLICATE_KEY]
+            if errors:
+                raise
+        return len(docs)
+
+    def run(self):
+        start_ts = self._attempt.read()
+        if start_ts is None:
+            start_ts = self.get_latest_ts()
+            self._attempt.write(start_ts)
+            LOG.warning('Initial sync starting at ts={} ({})'.format(
+                start_ts, ts2localtime(start_ts)))
+        else:
+            LOG.warning('Initial sync resuming, started at ts={} ({})'.format(
+                start_ts, ts2localtime(start_ts)))
+
+        t0_ = time.time()
+        namespaces = self.list_namespaces()
+
+        with ThreadPoolExecutor(self._workers) as pool:
+            futures = []
+            for ns in namespaces:
+                ranges = self.split_ranges(ns)
+                LOG.info('Copying {} in {} ranges'.format(ns, len(ranges)))
+                for min_id, max_id in ranges:
+                    futures.append(
+                        (ns, pool.submit(self.copy_range, ns, min_id, max_id)))
+
+            counts = {}
+            for ns, future in futures:
+                counts[ns] = counts.get(ns, 0) + future.result()
+
+            for ns in namespaces:
+                LOG.info('Copied {} documents of {}'.format(counts[ns], ns))
+
+            # building indexes on loaded data beats maintaining them
+            for future in [pool.submit(copy_index, self._index_coll(ns),
+                                       self._dst_coll(ns))
+                           for ns in namespaces]:
+                future.result()
+
+        self._checkpoint.write(start_ts)
+        self._attempt.clear()
+        LOG.warning('Initial sync of {} collections, {} documents done in '
+                    '{:.0f} secs, replay would start from ts={}'.format(
+                        len(namespaces), sum(counts.values()),
+                        time.time() - t0_, start_ts))
+
+    def close(self):
+        self._src.close()
+        self._dst.close()
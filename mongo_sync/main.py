@@ -7,6 +7,10 @@ import signal
 
 from mongo_sync import oplog_dump
 from mongo_sync import oplog_replay
+from mongo_sync import retention
+from mongo_sync import fanout
+from mongo_sync import metrics
+from mongo_sync.store import OplogStore
 from mongo_sync.config import conf
 from mongo_sync.emails import send_email
 
@@ -19,26 +23,81 @@ def alert(message):
     )
 
 
+def initial_sync():
+    from mongo_sync.initial_sync import InitialSync
+    sync = InitialSync()
+    try:
+        sync.run()
+    finally:
+        sync.close()
+
+
+def dump_oplog_async():
+    from mongo_sync import aio
+    om = aio.AsyncOplogDump()
+    rw = retention.RetentionWorker()
+
+    rw.start()
+    # returns after SIGINT/SIGTERM once in-flight slices are uploaded
+    om.start()
+    rw.safe_stop()
+
+    alert('oplog dump stopped')
+
+
+def replay_oplog_async():
+    from mongo_sync import aio
+    op = aio.AsyncOplogReplay()
+
+    # returns after SIGINT/SIGTERM once in-flight writes are checkpointed
+    op.start()
+
+    alert('oplog replay stopped')
+
+
 def dump_oplog():
-    om = oplog_dump.OplogDump()
+    sources = conf.get('sources')
+    if sources:
+        om = oplog_dump.MultiSourceDump(sources)
+        workers = [retention.RetentionWorker(OplogStore(source=s['name']))
+                   for s in sources]
+    else:
+        om = oplog_dump.OplogDump()
+        workers = [retention.RetentionWorker()]
 
     def exit_on_signal(sig, frame):
         om.safe_stop()
+        for rw in workers:
+            rw.safe_stop()
 
     signal.signal(signal.SIGINT, exit_on_signal)
     signal.signal(signal.SIGTERM, exit_on_signal)
 
     om.start()
+    for rw in workers:
+        rw.start()
 
     while om.is_running():
         time.sleep(5)
+
+    om.safe_stop()
+    for rw in workers:
+        rw.safe_stop()
     
     alert('oplog dump stopped')
 
 
 
 def replay_oplog():
-    op = oplog_replay.OplogReplay()
+    sources = conf.get('sources')
+    if conf.get('targets'):
+        op = fanout.FanoutReplay(conf['targets'])
+    elif not sources:
+        op = oplog_replay.OplogReplay()
+    elif conf.get('multi_source_replay', 'merge') == 'merge':
+        op = oplog_replay.MergedOplogReplay(sources)
+    else:
+        op = oplog_replay.MultiSourceReplay(sources)
 
     def exit_on_signal(sig, frame):
         op.safe_stop()
@@ -50,6 +109,8 @@ def replay_oplog():
 
     while op.is_running():
         time.sleep(5)
+
+    op.safe_stop()
     
     alert('oplog dump stopped')
 
@@ -63,14 +124,48 @@ def main():
     parser.add_argument(
         '--replay', dest='replay', action='store_true', default=False,
         help='load and repaly mongodb oplog')
+    parser.add_argument(
+        '--initial-sync', dest='initial_sync', action='store_true',
+        default=False,
+        help='clone collections to the target, then checkpoint replay '
+             'at the source oplog ts it started from')
+    parser.add_argument(
+        '--engine', dest='engine', choices=['thread', 'asyncio'],
+        default='thread',
+        help='threaded engine, or asyncio engine of pymongo')
 
     options = parser.parse_args()
 
-    if not(options.dump or options.replay):
+    if not(options.dump or options.replay or options.initial_sync):
         parser.print_help(sys.stderr)
         sys.exit(1)
-    else:
-        if options.dump:
+
+    # before any work, initial sync may take hours
+    asyncio_engine = options.engine == 'asyncio'
+    if (options.dump or options.replay) and asyncio_engine and (
+            conf.get('sources') or conf.get('targets')):
+        parser.error('multiple sources or targets are not supported by '
+                     'the asyncio engine')
+    if options.replay and conf.get('sources') and conf.get('targets'):
+        parser.error('replay of multiple sources to multiple targets '
+                     'is not supported')
+
+    if conf.get('metrics_port'):
+        metrics.start_http_server(conf['metrics_port'])
+
+    if options.initial_sync:
+        # replay continues from it if also asked
+        initial_sync()
+        if not (options.dump or options.replay):
+            return
+
+    if options.dump:
+        if asyncio_engine:
+            dump_oplog_async()
+        else:
             dump_oplog()
-        elif options.replay:
+    elif options.replay:
+        if asyncio_engine:
+            replay_oplog_async()
+        else:
             replay_oplog()
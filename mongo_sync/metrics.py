@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal metrics registry, exposed in Prometheus text format over HTTP
+"""
+
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60,
+                   float('inf'))
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+
+    type_ = None
+
+    def __init__(self, name, help_):
+        self.name = name
+        self.help = help_
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type_)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(
+                    self.name, _format_labels(key), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type_ = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_labels_key(labels)] = value
+
+
+class Histogram(Metric):
+
+    type_ = 'histogram'
+
+    def __init__(self, name, help_, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type_)]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name,
+                        _format_labels(key, [('le', _format_value(bound))]),
+                        count))
+                lines.append('{}_sum{} {}'.format(
+                    self.name, _format_labels(key), _format_value(total)))
+                lines.append('{}_count{} {}'.format(
+                    self.name, _format_labels(key), counts[-1]))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CAPTURE_LAG = REGISTRY.register(Gauge(
+    'mongo_sync_capture_lag_seconds',
+    'Source latest ts minus last saved ts, per source'))
+REPLAY_LAG = REGISTRY.register(Gauge(
+    'mongo_sync_replay_lag_seconds',
+    'Now minus ts of the last replayed entry, per target, or per source '
+    'when replayed independently'))
+SLICES = REGISTRY.register(Counter(
+    'mongo_sync_slices_total', 'Slices dumped or replayed'))
+ENTRIES = REGISTRY.register(Counter(
+    'mongo_sync_entries_total', 'Oplog entries dumped or replayed'))
+SLICE_BYTES = REGISTRY.register(Counter(
+    'mongo_sync_slice_bytes_total',
+    'Dumped slice bytes, raw BSON or compressed'))
+APPLIED_OPS = REGISTRY.register(Counter(
+    'mongo_sync_applied_ops_total', 'Replayed entries by op type'))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'mongo_sync_stage_seconds', 'Latency of dump/replay stages'))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr=''):
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics',
+                              daemon=True)
+    thread.start()
+    LOG.warning('Serving metrics on {}:{}'.format(addr, port))
+    return server
@@ -5,9 +5,17 @@ import pickle
 import hashlib
 import lz4.block
 
+import bson
 import pymongo
+from pymongo import monitoring
 from gridfs import GridFS
-from bson import ObjectId
+from bson import ObjectId, CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from mongo_sync.utils import timeit
+from mongo_sync.codecs import get_codec
+
+RAW_BSON_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
 
 
 def compress(b):
@@ -20,6 +28,8 @@ def decompress(b):
 
 class Serializer:
 
+    CODEC = b'lz4-block'
+
     @staticmethod
     def serialize(obj):
         ret = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
@@ -27,7 +37,24 @@ class Serializer:
         return ret
 
     @staticmethod
-    def deserialize(b):
+    def iter_entries(f, allow_pickle=True):
+        """
+        Yield entries from a file-like object, raw BSON slices are decoded
+        incrementally as data arrives
+        """
+        head = f.read(len(RawBSONSerializer.MAGIC))
+        if RawBSONSerializer.is_raw_bson(head):
+            yield from RawBSONSerializer.iter_stream(f)
+        else:
+            yield from Serializer.deserialize(head + f.read(),
+                                              allow_pickle=allow_pickle)
+
+    @staticmethod
+    def deserialize(b, allow_pickle=True):
+        if RawBSONSerializer.is_raw_bson(b):
+            return RawBSONSerializer.deserialize(b)
+        if not allow_pickle:
+            raise Exception('Refused to unpickle legacy slice')
         try:
             b = decompress(b)
         except lz4.block.LZ4BlockError:
@@ -43,14 +70,191 @@ class Serializer:
             return md5, bytes_
         return md5
 
+
+class RawBSONSerializer:
+    """
+    Slice format of concatenated raw BSON documents (each carries its own
+    int32 length prefix), compressed behind a small header naming the codec:
+
+        b'MSRB' | codec id length (1 byte) | codec id
+
+    Documents are passed through as `RawBSONDocument`, so neither dump nor
+    replay decodes and re-encodes entries.
+    """
+
+    MAGIC = b'MSRB'
+
+    @classmethod
+    def is_raw_bson(cls, b):
+        return bytes(b[:len(cls.MAGIC)]) == cls.MAGIC
+
+    @classmethod
+    def header(cls, codec):
+        codec_id = codec.id.encode()
+        return cls.MAGIC + bytes([len(codec_id)]) + codec_id
+
+    @staticmethod
+    def raw(doc):
+        if isinstance(doc, RawBSONDocument):
+            return doc.raw
+        if isinstance(doc, bytes):
+            return doc
+        return bson.encode(doc)
+
+    @classmethod
+    def serialize(cls, docs, codec=None):
+        codec = codec or get_codec()
+        body = b''.join(cls.raw(doc) for doc in docs)
+        return cls.header(codec) + codec.compress(body)
+
+    @classmethod
+    def deserialize(cls, b):
+        offset = len(cls.MAGIC)
+        codec_len = b[offset]
+        codec = get_codec(bytes(b[offset + 1:offset + 1 + codec_len]).decode())
+        # no copy of the compressed payload, `b` may be mmap-ed
+        with memoryview(b) as view:
+            body = codec.decompress(view[offset + 1 + codec_len:])
+        return bson.decode_all(body, RAW_BSON_CODEC_OPTIONS)
+
+    @staticmethod
+    def _split(buf):
+        """
+        Cut complete documents off `buf`, return them with bytes consumed
+        """
+        docs = []
+        pos = 0
+        while len(buf) - pos >= 4:
+            size = int.from_bytes(buf[pos:pos + 4], 'little')
+            if len(buf) - pos < size:
+                break
+            docs.append(RawBSONDocument(bytes(buf[pos:pos + size]),
+                                        RAW_BSON_CODEC_OPTIONS))
+            pos += size
+        return docs, pos
+
+    @classmethod
+    def iter_stream(cls, f, chunk_size=262144):
+        """
+        Yield `RawBSONDocument`s from a file-like object positioned right
+        after the magic bytes
+        """
+        codec_len = f.read(1)[0]
+        codec = get_codec(f.read(codec_len).decode())
+
+        decompressor = codec.decompressor()
+        buf = bytearray()
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                buf += decompressor.decompress(chunk)
+            else:
+                buf += decompressor.flush()
+
+            docs, pos = cls._split(buf)
+            yield from docs
+            # drop consumed bytes
+            del buf[:pos]
+
+            if not chunk:
+                break
+
+        if buf:
+            raise Exception('Truncated slice, {} trailing bytes'.format(
+                len(buf)))
+
+
+class RawBSONWriter(object):
+    """
+    Write entries to a file-like object in raw BSON slice format, encoding
+    and compressing them one at a time
+    """
+
+    def __init__(self, f, codec=None):
+        codec = codec or get_codec()
+        self._f = f
+        self._compressor = codec.compressor()
+        f.write(RawBSONSerializer.header(codec))
+
+    def write(self, doc):
+        data = self._compressor.compress(RawBSONSerializer.raw(doc))
+        if data:
+            self._f.write(data)
+
+    def close(self):
+        self._f.write(self._compressor.flush())
+
+
 serializer = Serializer
 
+SERIALIZERS = {
+    'pickle': Serializer,
+    'raw_bson': RawBSONSerializer,
+}
+
+
+@timeit('serialize')
+def encode_slice(fmt, docs, codec=None):
+    """
+    Module level so that it can run in a process pool; raw BSON documents
+    should be passed as bytes then. Latency is not recorded in this process
+    then.
+    """
+    if fmt == 'raw_bson':
+        return RawBSONSerializer.serialize(docs, codec)
+    return SERIALIZERS[fmt].serialize(docs)
+
+
+class ConnectionCounter(monitoring.ConnectionPoolListener):
+    """
+    Count connections a client opens, to verify connection churn
+    """
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+
+    def connection_created(self, event):
+        self.opened += 1
+
+    def connection_closed(self, event):
+        self.closed += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
 
 class MongoStore(object):
     
     config_settings = {}
     
-    def __init__(self, uri=None, db_name=None):
+    def __init__(self, uri=None, db_name=None, allow_pickle=True,
+                 collection='fs', **client_kwargs):
+
+        self.allow_pickle = allow_pickle
+        # GridFS bucket, i.e. `<collection>.files` and `<collection>.chunks`
+        self.collection = collection
 
         if uri is None:
             db_name = self.config_settings['name'] 
@@ -58,49 +262,90 @@ class MongoStore(object):
             username = self.config_settings['username']
             password = self.config_settings['password']
             
-            self.db = pymongo.MongoClient(mongo_host)[db_name]
+            self.db = pymongo.MongoClient(mongo_host, **client_kwargs)[db_name]
             self.db.authenticate(username, password)
         else:
             if db_name is None:
                 raise Exception('Must provide target db name')
-            self.db = pymongo.MongoClient(uri)[db_name]
+            self.db = pymongo.MongoClient(uri, **client_kwargs)[db_name]
         
-        self.fs = GridFS(self.db)
+        self.fs = GridFS(self.db, collection)
         
-    def write(self, name, df, metadata='', upsert=True):
+    def write(self, name, df, metadata='', upsert=True, fmt='pickle'):
         
         if upsert:
             self.delete(name)
             
-        if name in self.fs.list():
+        return self.put(name, SERIALIZERS[fmt].serialize(df),
+                        metadata=metadata, upsert=False)
+
+    def put(self, name, data, metadata='', upsert=True):
+        """
+        Write already serialized bytes
+        """
+
+        if upsert:
+            self.delete(name)
+
+        if self.fs.exists(filename=name):
             warnings.warn(
                 'filename `{}` already exists, nothing inserted'.format(name))
             return 
                             
         return self.fs.put(
-            serializer.serialize(df),
+            data,
             filename=name,
             metadata=metadata
         )
     
+    def new_file(self, **kwargs):
+        return self.fs.new_file(**kwargs)
+
+    def rename(self, file_id, name):
+        self.db[self.collection + '.files'].update_one(
+            {'_id': file_id}, {'$set': {'filename': name}})
+
     def delete(self, name):
-        doc = self.db['fs.files'].find_one(
+        doc = self.db[self.collection + '.files'].find_one(
             {'filename': name})
         if doc:
             _id = doc.get('_id')
             self.fs.delete(_id)
         
+    def delete_many(self, names):
+        """
+        Delete files by name, files before chunks as `GridFS.delete` does
+        """
+        files = self.db[self.collection + '.files']
+        ids = [doc['_id'] for doc in files.find(
+            {'filename': {'$in': names}}, {'_id': 1})]
+        if ids:
+            files.delete_many({'_id': {'$in': ids}})
+            self.db[self.collection + '.chunks'].delete_many(
+                {'files_id': {'$in': ids}})
+        return len(ids)
+
     def read(self, name):
+        sr = self.read_bytes(name)
+        return serializer.deserialize(sr, allow_pickle=self.allow_pickle)
 
-        def _read(name):
-            return self.fs.find_one(
-                {'filename': name}).read()
+    def read_bytes(self, name):
+        return self.fs.find_one(
+            {'filename': name}).read()
 
-        sr = _read(name)
-        return serializer.deserialize(sr)
+    def read_stream(self, name):
+        """
+        Yield entries as GridFS chunks arrive
+        """
+        grid_out = self.fs.find_one({'filename': name})
+        try:
+            yield from serializer.iter_entries(
+                grid_out, allow_pickle=self.allow_pickle)
+        finally:
+            grid_out.close()
     
     def read_metadata(self, name):
-        return self.db['fs.files'].find_one(
+        return self.db[self.collection + '.files'].find_one(
             {'filename': name}).get('metadata')
     
     def list(self):
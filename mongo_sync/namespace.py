@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import re
+import collections
+
+from mongo_sync.utils import namespace_to_regex
+
+
+class NamespaceFilter(object):
+    """
+    Decide whether entries of a namespace should be synced.
+
+    Whitelist (or else blacklist) patterns are compiled into one
+    alternation, and decisions are cached per namespace in a bounded LRU.
+    A decision only depends on the namespace, so collections created or
+    renamed during replay simply get their own cache entries.
+    """
+
+    def __init__(self, whitelist=None, blacklist=None, cache_size=10000):
+        self.whitelist = whitelist or []
+        self.blacklist = blacklist or []
+
+        if self.whitelist:
+            self._regex = self.compile(self.whitelist)
+            self._include = True
+        elif self.blacklist:
+            self._regex = self.compile(self.blacklist)
+            self._include = False
+        else:
+            self._regex = None
+
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def compile(patterns):
+        return re.compile('|'.join(
+            '(?:{})'.format(namespace_to_regex(ns).pattern)
+            for ns in patterns))
+
+    def _decide(self, ns):
+        coll = ns.split('.', 1)[1] if '.' in ns else ''
+        # ignore system.indexes
+        if coll.startswith('system.'):
+            return False
+        if coll == '$cmd':
+            return True
+        if self._regex is None:
+            return True
+        return (self._regex.match(ns) is not None) == self._include
+
+    def should_sync(self, ns):
+        try:
+            decision = self._cache[ns]
+        except KeyError:
+            self.misses += 1
+            decision = self._decide(ns)
+            self._cache[ns] = decision
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self._cache.move_to_end(ns)
+        return decision
+
+    def to_query(self):
+        """
+        Predicate on `ns` for the oplog query, None if nothing is filtered.
+        Commands always pass, they are filtered at replay.
+        """
+        patterns = self.whitelist or self.blacklist
+        if not patterns:
+            return None
+
+        exact = [ns for ns in patterns if '*' not in ns]
+        wildcard = [ns for ns in patterns if '*' in ns]
+
+        if self.whitelist:
+            ns_conds = []
+            if exact:
+                ns_conds.append({'ns': {'$in': exact}})
+            if wildcard:
+                ns_conds.append({'ns': self.compile(wildcard)})
+            return {'$or': [{'op': 'c'}] + ns_conds}
+
+        ns_cond = {}
+        if exact:
+            ns_cond['$nin'] = exact
+        if wildcard:
+            ns_cond['$not'] = self.compile(wildcard)
+        return {'$or': [{'op': 'c'}, {'ns': ns_cond}]}
+
+    @staticmethod
+    def _covers_pattern(pattern, other):
+        # `other` taken literally, its wildcards are matched by those of
+        # `pattern` only
+        return namespace_to_regex(pattern).match(other) is not None
+
+    def covers(self, other):
+        """
+        Whether every namespace synced by filter `other` is synced by this
+        one as well, as far as can be told from the patterns, False if not
+        sure
+        """
+        if self._regex is None:
+            return True
+        if other._regex is None:
+            return False
+        if self._include and other._include:
+            return all(any(self._covers_pattern(p, o) for p in self.whitelist)
+                       for o in other.whitelist)
+        if not self._include and not other._include:
+            return all(any(self._covers_pattern(o, p) for o in other.blacklist)
+                       for p in self.blacklist)
+        if not self._include:
+            # wildcards of a whitelist may overlap the blacklist
+            return all('*' not in o and self.should_sync(o)
+                       for o in other.whitelist)
+        return False
+
+    def spec(self):
+        return {'whitelist': self.whitelist, 'blacklist': self.blacklist}
+
+    def stats(self):
+        return 'filter hits={}, misses={}'.format(self.hits, self.misses)
@@ -7,30 +7,81 @@ import threading
 import logging
 
 import pymongo
-
-from mongo_sync.utils import timeit, dt2ts, slice_name_to_ts, ts2localtime
-from mongo_sync.store import OplogStore
+from bson import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from mongo_sync.utils import timeit, dt2ts, StageTimer
+from mongo_sync.metrics import CAPTURE_LAG, SLICES, ENTRIES, SLICE_BYTES
+from mongo_sync.store import OplogStore, SliceWriter, slice_codec
+from mongo_sync.pipeline import DumpPipeline
+from mongo_sync.namespace import NamespaceFilter
+from mongo_sync.compaction import compact, UniqueIndexes
 from mongo_sync.config import conf
 
 LOG = logging.getLogger('oplog_dump')
 
-OPLOG_KEEP_DAYS = conf['keep_days']
-
 
 class OplogDump(object):
+    """
+    Capture the oplog of `src_url`, or of `source`, one of `sources` each
+    dumped into its own slice stream
+    """
 
-    def __init__(self, start=None, interval=None):
+    def __init__(self, start=None, interval=None, source=None):
 
-        self._oplog_store = OplogStore()
+        if source is None:
+            self.name = None
+            src_url = conf['src_url']
+        else:
+            self.name = source['name']
+            src_url = source['url']
 
-        self._client = pymongo.MongoClient(conf['src_url'])
-        self._oplog = self._client['local']['oplog.rs']
+        self._oplog_store = OplogStore(source=self.name)
+
+        self._client = pymongo.MongoClient(src_url)
+        if conf.get('slice_format', 'pickle') == 'raw_bson':
+            # entries are stored as fetched, without decoding
+            codec_options = CodecOptions(document_class=RawBSONDocument)
+        else:
+            codec_options = None
+        self._oplog = self._client['local'].get_collection(
+            'oplog.rs', codec_options=codec_options)
 
         self._initialize_slice_range(start, interval)
 
         self._hungry = False
         self._running = False
 
+        self._mode = conf.get('oplog_dump_mode', 'interval')
+        # max seconds an entry stays buffered in streaming mode
+        self._stream_slice_seconds = conf.get('stream_slice_seconds', 1)
+
+        # slices also roll over on entry count or uncompressed size,
+        # whichever comes first, 0 for unlimited
+        self._slice_max_entries = conf.get('slice_max_entries', 0)
+        self._slice_max_bytes = conf.get('slice_max_bytes', 0)
+
+        self._pipeline = None
+        self._timer = StageTimer()
+
+        # encode and upload entries as the cursor yields them
+        self._streaming_upload = conf.get('dump_streaming_upload', False)
+
+        self._initialize_filter()
+
+        # only merged replay of several sources needs capture progress,
+        # which is probed with the capture lag in streaming mode, at most
+        # every this many seconds
+        self._mark_progress = self.name is not None
+        self._progress_interval = conf.get('capture_progress_interval', 5)
+
+        self._compact = conf.get('compact_slices') == 'dump'
+        if self._compact and self._streaming_upload:
+            LOG.warning('Slices streamed into the store are not compacted')
+        self._unique_indexes = None
+        if self._compact:
+            self._unique_indexes = UniqueIndexes(self._client)
+
     def _initialize_slice_range(self, start, interval):
 
         _start = self.get_first_ts()
@@ -57,6 +108,32 @@ class OplogDump(object):
 
         LOG.info('Initial ts={}, interval={}'.format(self._start_ts, interval))
 
+    def _initialize_filter(self):
+        self._ns_query = None
+        self._projection = conf.get('dump_projection') or None
+
+        if conf.get('dump_filter', False):
+            ns_filter = NamespaceFilter(conf['whitelist'], conf['blacklist'])
+            self._ns_query = ns_filter.to_query()
+            if self._ns_query is not None:
+                # recorded with slices, for replayers to detect mismatch
+                self._oplog_store.dump_filter = dict(
+                    ns_filter.spec(), projection=self._projection)
+
+        LOG.info('Dump filter={}, projection={}'.format(
+            self._ns_query, self._projection))
+
+    def oplog_query(self, ts_cond):
+        query = {'op': {'$ne': 'n'}, 'ts': ts_cond}
+        if self._ns_query is not None:
+            query = {'$and': [query, self._ns_query]}
+        return query
+
+    @property
+    def lag_label(self):
+        # lag gauge series of this instance
+        return self.name or 'default'
+
     def is_running(self):
         if not self._running:
             return False
@@ -64,19 +141,17 @@ class OplogDump(object):
             return False
         return True
 
-    def remove_expiration(self):
-        slice_names = self._oplog_store.list_names()
-
-        if slice_names:
-            first_name = min(slice_names)
-            first_dt = ts2localtime(slice_name_to_ts(first_name))
-
-            if (datetime.date.today() - first_dt.date()).days > OPLOG_KEEP_DAYS:
-                self._oplog_store.remove(first_name)
-                LOG.info('Removed slice {}'.format(first_name))
-
     def save_sliced(self, sliced):
-        self._oplog_store.dump_oplog(self._last_ts, sliced)
+        if self._compact:
+            size = len(sliced)
+            sliced = compact(sliced, self._unique_indexes)
+            LOG.info('Compacted size={} to {}, ratio={:.2f}'.format(
+                size, len(sliced), len(sliced) / size))
+
+        if self._pipeline is not None:
+            self._pipeline.submit(sliced)
+        else:
+            self._oplog_store.dump_oplog(self._last_ts, sliced)
 
     def get_last_saved_ts(self):
         return self._oplog_store.get_last_saved_ts()
@@ -86,42 +161,112 @@ class OplogDump(object):
             {'op': {'$ne': 'n'}}, sort=[('$natural', pymongo.ASCENDING)]
         )['ts']
 
+    @timeit('latest_ts')
     def get_latest_ts(self):
         return self._oplog.find_one(
             {'op': {'$ne': 'n'}}, sort=[('$natural', pymongo.DESCENDING)]
         )['ts']
 
+    def get_latest_any_ts(self):
+        # including no-ops, which idle shards write periodically
+        return self._oplog.find_one(
+            {}, {'ts': 1}, sort=[('$natural', pymongo.DESCENDING)])['ts']
+
+    def is_slice_full(self, num_entries, num_bytes):
+        if self._slice_max_entries and num_entries >= self._slice_max_entries:
+            return True
+        if self._slice_max_bytes and num_bytes >= self._slice_max_bytes:
+            return True
+        return False
+
     def slice_oplog(self):
+        """
+        Dump entries up to `_next_ts`, True if stopped early as the slice
+        is full
+        """
 
         def get_cursor():
-            query = {'op': {'$ne': 'n'},
-                     'ts': {'$gt': self._last_ts, '$lte': self._next_ts}}
+            query = self.oplog_query(
+                {'$gt': self._last_ts, '$lte': self._next_ts})
             cursor = self._oplog.find(
                 query,
+                self._projection,
                 cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
                 oplog_replay=True)
             return cursor
 
         cursor = get_cursor()
-        sliced = list(cursor)
-
-        if not sliced:
+        writer = self.new_slice()
+        full = False
+        try:
+            with self._timer.time('query'):
+                for entry in cursor:
+                    writer.write(entry)
+                    if self.is_slice_full(writer.count, writer.num_bytes):
+                        # the rest is picked up from writer.last_ts next round
+                        LOG.info('Slice full, entries={}, bytes={}'.format(
+                            writer.count, writer.num_bytes))
+                        full = True
+                        break
+        except Exception:
+            writer.abort()
+            raise
+        finally:
+            cursor.close()
+
+        if not writer.count:
+            writer.abort()
             LOG.info(f'No oplog records between '
                      f'{self._last_ts} and {self._next_ts}')
             self._last_ts = self._next_ts
-            return
+            self.mark_captured(self._next_ts)
+            return False
 
-        self._last_ts = sliced[-1]['ts']
-        self.save_sliced(sliced)
+        self.emit(writer)
+        if not full:
+            self.mark_captured(self._next_ts)
+        return full
 
-        LOG.info('Dumped size={}, ts={}'.format(len(sliced), self._last_ts))
+    def mark_captured(self, ts):
+        """
+        Advance the capture progress of this source, read by merged replay
+        """
+        if not self._mark_progress:
+            return
+        if self._pipeline is not None:
+            # after slices still queued for upload
+            self._pipeline.mark_captured(ts)
+        else:
+            self._oplog_store.mark_captured(ts)
+
+    def new_slice(self):
+        """
+        Writer for the next slice, entries are encoded and uploaded as they
+        come if the store supports it, otherwise buffered until `emit`
+        """
+        if self._streaming_upload:
+            writer = self._oplog_store.open_slice_writer()
+            if writer is not None:
+                return writer
+        return SliceWriter(self.save_sliced)
+
+    def emit(self, writer):
+        self._last_ts = writer.last_ts
+        writer.commit()
+
+        SLICES.inc(process='dump')
+        ENTRIES.inc(writer.count, process='dump')
+        SLICE_BYTES.inc(writer.num_bytes, kind='raw')
+
+        LOG.info('Dumped size={}, bytes={}, ts={}'.format(
+            writer.count, writer.num_bytes, self._last_ts))
 
     def run_dumping(self):
 
+        # entries left behind a full slice are dumped without waiting
+        backlog = False
         try:
             while self._running:
-                self.remove_expiration()
-
                 if self._last_ts is None:
                     self._last_ts = self._start_ts
 
@@ -129,24 +274,146 @@ class OplogDump(object):
                                     self._slice_interval)
 
                 latest_ts = self.get_latest_ts()
+                CAPTURE_LAG.set(latest_ts.time - self._last_ts.time,
+                                source=self.lag_label)
 
-                if latest_ts < self._next_ts:
+                if latest_ts < self._next_ts and not backlog:
                     self._hungry = True
                     LOG.info('Hungry, waiting feed...')
                     time.sleep(self._next_ts.time - latest_ts.time)
                 else:
-                    if self._hungry:
+                    if backlog:
+                        # up to the head at most
+                        self._next_ts = min(self._next_ts, latest_ts)
+                    elif self._hungry:
                         self._next_ts = latest_ts
-                        self._hungry = False
-                    self.slice_oplog()
+                    self._hungry = False
+                    backlog = self.slice_oplog()
+        except Exception as e:
+            LOG.error(str(e), exc_info=True)
+        finally:
+            self.close()
+
+        LOG.warning('Oplog dumping stopped.')
+
+    def open_stream(self):
+        query = self.oplog_query({'$gt': self._last_ts})
+        cursor = self._oplog.find(
+            query,
+            self._projection,
+            cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+            oplog_replay=True)
+        cursor.max_await_time_ms(
+            int(min(1, self._stream_slice_seconds) * 1000))
+        LOG.info('Opened oplog stream from ts={}'.format(self._last_ts))
+        return cursor
+
+    def run_streaming(self):
+        """
+        Keep one tailable cursor open and cut slices from the live stream.
+        A slice is emitted once its first entry has been buffered for
+        `stream_slice_seconds`, when it is full, or when the cursor dies.
+        If the cursor fails, unemitted entries are dropped and the stream
+        resumes from the last emitted ts.
+        """
+        if self._last_ts is None:
+            self._last_ts = self._start_ts
+
+        cursor = None
+        writer = None
+        slice_started = None
+        # entries up to it are all emitted once a poll returns nothing
+        # with no slice pending
+        probe_ts = None
+        probed_at = 0
+
+        try:
+            while self._running:
+                if cursor is None:
+                    cursor = self.open_stream()
+
+                if time.time() - probed_at >= self._progress_interval:
+                    latest_ts = self.get_latest_ts()
+                    CAPTURE_LAG.set(latest_ts.time - self._last_ts.time,
+                                    source=self.lag_label)
+                    if self._mark_progress and probe_ts is None:
+                        probe_ts = self.get_latest_any_ts()
+                    probed_at = time.time()
+
+                try:
+                    with self._timer.time('query'):
+                        entry = cursor.next()
+                except StopIteration:
+                    # a getMore came back empty, the cursor may be alive
+                    entry = None
+                except (pymongo.errors.AutoReconnect,
+                        pymongo.errors.OperationFailure) as e:
+                    LOG.warning('Oplog stream broken: {}, resuming from '
+                                'ts={}'.format(e, self._last_ts))
+                    cursor.close()
+                    cursor = None
+                    if writer is not None:
+                        writer.abort()
+                        writer = None
+                    time.sleep(1)
+                    continue
+
+                if entry is None and writer is None and probe_ts is not None:
+                    # nothing pending, all up to the probe captured
+                    self.mark_captured(probe_ts)
+                    probe_ts = None
+
+                if entry is not None:
+                    if writer is None:
+                        writer = self.new_slice()
+                        slice_started = time.time()
+                    writer.write(entry)
+
+                if writer is not None and (
+                        not cursor.alive or
+                        self.is_slice_full(writer.count, writer.num_bytes) or
+                        time.time() - slice_started >=
+                        self._stream_slice_seconds):
+                    self.emit(writer)
+                    writer = None
+
+                if not cursor.alive:
+                    # dies immediately if nothing newer than the query ts
+                    cursor = None
+                    if entry is None:
+                        time.sleep(min(1, self._stream_slice_seconds))
         except Exception as e:
             LOG.error(str(e), exc_info=True)
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if writer is not None:
+                writer.abort()
+            self.close()
 
         LOG.warning('Oplog dumping stopped.')
 
+    def close(self):
+        try:
+            if self._pipeline is not None:
+                self._pipeline.close()
+        finally:
+            self._oplog_store.close()
+
     def start(self):
         self._running = True
-        self._thread = threading.Thread(target=self.run_dumping)
+        self._oplog_store.open()
+        if conf.get('dump_pipeline', False):
+            self._pipeline = DumpPipeline(
+                self._oplog_store, conf.get('slice_format', 'pickle'),
+                codec=slice_codec,
+                processes=conf.get('dump_encode_processes', 0),
+                queue_size=conf.get('dump_pipeline_queue', 4))
+        if self._mode == 'stream':
+            target = self.run_streaming
+        else:
+            target = self.run_dumping
+        self._thread = threading.Thread(target=target)
         self._thread.start()
         LOG.warning('Started pid={}, dumping thread={}'.format(
                 os.getpid(), self._thread.ident))
@@ -154,3 +421,25 @@ class OplogDump(object):
     def safe_stop(self):
         self._running = False
         LOG.warning('Would stop as soon as current slice dumping completes.')
+
+
+class MultiSourceDump(object):
+    """
+    Capture each of `sources`, e.g. the shards of a cluster, concurrently
+    into its own slice stream
+    """
+
+    def __init__(self, sources, start=None, interval=None):
+        self._dumps = [OplogDump(start, interval, source=source)
+                       for source in sources]
+
+    def is_running(self):
+        return all(om.is_running() for om in self._dumps)
+
+    def start(self):
+        for om in self._dumps:
+            om.start()
+
+    def safe_stop(self):
+        for om in self._dumps:
+            om.safe_stop()
@@ -6,31 +6,113 @@ import logging
 import pymongo
 
 import threading
+import queue
+import heapq
+import collections
 import datetime
 import dateutil
 import time
 
-from bson import SON, Timestamp
+from bson import SON
+from pymongo import ReplaceOne, UpdateOne, DeleteOne
 
 from mongo_sync.utils import (timeit, dt2ts, ts2localtime, ts_to_slice_name,
-                              slice_name_to_ts, namespace_to_regex)
-from mongo_sync.store import OplogStore
+                              slice_name_to_ts, namespace_to_regex,
+                              get_doc_id, StageTimer)
+from mongo_sync.metrics import REPLAY_LAG, SLICES, ENTRIES, APPLIED_OPS
+from mongo_sync.store import (OplogStore, slice_poll_min_interval,
+                              slice_poll_max_interval)
+from mongo_sync.pipeline import SlicePrefetcher
+from mongo_sync.namespace import NamespaceFilter
+from mongo_sync.compaction import compact, UniqueIndexes
+from mongo_sync.checkpoint import make_checkpoint
 from mongo_sync.config import conf
 
 LOG = logging.getLogger('oplog_replay')
 
 
 class OplogReplay(object):
+    """
+    Replay slices dumped from `src_url`, or from `source`, one of the
+    `sources` names, to `dst_url`, or to `target`, one of `targets`. Each
+    source or target has its own checkpoint.
+    """
 
-    def __init__(self, start=None):
+    # shared by replayers of a `FanoutReplay`
+    slice_cache = None
+    lag_window = None
 
-        self._oplog_store = OplogStore()
+    def __init__(self, start=None, source=None, target=None):
+
+        if target is None:
+            self.name = source
+            self._dst_url = conf['dst_url']
+        else:
+            self.name = target['name']
+            self._dst_url = target['url']
+
+        self._oplog_store = self.make_oplog_store(source)
 
         self._running = False
 
+        self._checkpoint = make_checkpoint(name=self.name, url=self._dst_url)
+        # checkpoint within a slice every N entries or T seconds
+        self._checkpoint_entries = conf.get('checkpoint_every_entries', 10000)
+        self._checkpoint_seconds = conf.get('checkpoint_every_seconds', 5)
+        self._last_checkpoint = time.time()
+
         self._initialize_start_time(start)
 
-        self.docman = DocManager()
+        self.docman = self.make_docman()
+
+        self._timer = StageTimer()
+
+        # number of slices to fetch and decode ahead, 0 to disable
+        self._prefetch_depth = conf.get('replay_prefetch', 0)
+        self._prefetcher = None
+
+        # apply entries while the slice is still being read
+        self._streaming = conf.get('replay_streaming', False)
+
+        self._compact = conf.get('compact_slices') == 'replay'
+        if self._compact and self._streaming:
+            LOG.warning('Streamed slices are not compacted')
+        self._unique_indexes = None
+        if self._compact:
+            self._unique_indexes = UniqueIndexes(
+                pymongo.MongoClient(self._dst_url))
+
+        # `warn` or `stop` on slices filtered differently at dump
+        self._filter_mismatch = conf.get('dump_filter_mismatch', 'warn')
+        self._checked_filters = []
+        self._replay_filter = NamespaceFilter(
+            conf['whitelist'], conf['blacklist'])
+
+    def make_oplog_store(self, source):
+        return OplogStore(source=source)
+
+    def open_stores(self):
+        self._oplog_store.open()
+
+    def close_stores(self):
+        self._oplog_store.close()
+
+    def make_docman(self):
+        if conf.get('bulk_replay', False):
+            docman_cls = BulkDocManager
+        else:
+            docman_cls = DocManager
+
+        client = pymongo.MongoClient(self._dst_url)
+        num_workers = conf.get('replay_workers', 1)
+        if num_workers > 1:
+            return PartitionedApplier(
+                num_workers, lambda: docman_cls(client=client))
+        return docman_cls(client=client)
+
+    @property
+    def last_ts(self):
+        return self._last_ts
 
     def _initialize_start_time(self, start):
         start = start or conf['replay_start_time']
@@ -41,8 +123,9 @@ class OplogReplay(object):
         self._last_ts = dt2ts(start)
         sync_tag = self.read_tag_file()
         if sync_tag == -1:
-            err_msg = 'Sync process crashed last time, ' +\
-                'have to manually restore db state'
+            # left by versions that only tagged progress per slice
+            err_msg = 'Sync process crashed last time with a legacy tag ' +\
+                'file, have to manually restore db state'
             LOG.warning(err_msg)
             raise Exception(err_msg)
         elif sync_tag is not None:
@@ -54,6 +137,11 @@ class OplogReplay(object):
                 LOG.warning(err_msg)
                 raise Exception(err_msg)
 
+    @property
+    def lag_label(self):
+        # lag gauge series of this instance
+        return self.name or 'default'
+
     def is_running(self):
         if not self._running:
             return False
@@ -61,58 +149,162 @@ class OplogReplay(object):
             return False
         return True
 
-    def load_oplog(self):
-        oplog = self._oplog_store.load_oplog(self._last_ts)
-        if oplog:
-            if oplog[0]['ts'] <= self._last_ts:
-                _start = None
-                for n, entry in enumerate(oplog):
-                    if entry['ts'] > self._last_ts:
-                        _start = n
-                        break
-                oplog = oplog[_start:]
-                LOG.warning('Resumed, would start sync from {}'.format(oplog[0]['ts']))
-            return oplog
-        else:
-            return None
+    def is_active(self):
+        # started and not asked to stop, possibly still starting
+        return self._running
 
-    def write_tag_file(self, ts=None):
-        if ts is None:
-            tag = '-1'
+    def fetch_decode(self, name):
+        with self._timer.time('fetch'):
+            data = self._oplog_store.fetch(name)
+        with self._timer.time('decode'):
+            return self._oplog_store.decode(data)
+
+    def load_oplog(self):
+        """
+        Load entries of the next slice, None if not any
+        """
+        if self._prefetcher is not None:
+            item = self._prefetcher.get(timeout=10)
+            if item is None:
+                oplog = None
+            else:
+                name, oplog = item
+                self.check_filter(name)
         else:
-            tag = '{}_{}={}'.format(ts.time, ts.inc, ts2localtime(ts))
-        with open('tag_file', 'w') as f:
-            f.write(tag)
-    
-    def read_tag_file(self):
-        fname = 'tag_file'
-        if os.path.exists(fname):
-            with open(fname, 'r') as f:
-                tag = f.read()
-            
-            if tag == '-1':
-                return -1
-            _time, _inc = tag.split('=')[0].split('_')
-            ts = Timestamp(int(_time), int(_inc))
-            return ts
-        return None
+            name = self._oplog_store.next_slice_name(self._last_ts)
+            if name is not None:
+                self.check_filter(name)
+                if self.lag_window is not None and not self.lag_window.wait(
+                        self, slice_name_to_ts(name)):
+                    return None
+
+            if name is None:
+                oplog = None
+            elif self.slice_cache is not None:
+                oplog = self.slice_cache.get(name, self.fetch_decode)
+            elif self._streaming:
+                oplog = self._oplog_store.stream(name)
+            else:
+                oplog = self.fetch_decode(name)
 
-    def replay(self, oplog):
+        if oplog is None:
+            return None
 
-        # Set tag to negative state each time before replay 
-        self.write_tag_file()
+        if self._compact and isinstance(oplog, list):
+            size = len(oplog)
+            with self._timer.time('compact'):
+                oplog = compact(oplog, self._unique_indexes)
+            LOG.info('Compacted size={} to {}, ratio={:.2f}'.format(
+                size, len(oplog), len(oplog) / max(size, 1)))
+
+        return self._skip_replayed(oplog)
+
+    def wait_for_slice(self, timeout):
+        """
+        Wake up as soon as the next slice is saved
+        """
+        return self._oplog_store.wait_for_slice(self._last_ts, timeout)
+
+    def check_filter(self, name, oplog_store=None):
+        """
+        Detect slices filtered at dump by a whitelist/blacklist not covering
+        the replay one, they may lack entries this replayer would sync
+        """
+        oplog_store = oplog_store or self._oplog_store
+        spec = oplog_store.slice_filter(name)
+        if spec is None or spec in self._checked_filters:
+            return
+        dump_filter = NamespaceFilter(
+            spec.get('whitelist'), spec.get('blacklist'))
+        if not dump_filter.covers(self._replay_filter):
+            err_msg = 'Slice {} was filtered at dump by {}, ' \
+                'does not cover replay filter'.format(name, spec)
+            if self._filter_mismatch == 'stop':
+                raise Exception(err_msg)
+            LOG.warning(err_msg)
+        self._checked_filters.append(spec)
 
+    def _skip_replayed(self, oplog):
+        last_ts = self._last_ts
+        skipped = False
         for entry in oplog:
-            # TODO: log excep
-            self.docman.process(entry)
+            if entry['ts'] <= last_ts:
+                skipped = True
+                continue
+            if skipped:
+                LOG.warning('Resumed, would start sync from {}'.format(
+                    entry['ts']))
+                skipped = False
+            yield entry
+
+    def write_tag_file(self, ts):
+        self._checkpoint.write(ts)
 
-        self._last_ts = entry['ts']
-        self.write_tag_file(self._last_ts)
+    def read_tag_file(self):
+        return self._checkpoint.read()
+
+    def checkpoint(self, ts):
+        """
+        Record progress once everything up to `ts` is applied. Entries after
+        the last checkpoint are re-applied after a crash, which is safe as
+        oplog entries are idempotent: inserts are upsert replaces, updates
+        set values and deletes go by `_id`.
+        """
+        with self._timer.time('checkpoint'):
+            self.docman.flush()
+            self.write_tag_file(ts)
+        self._last_checkpoint = time.time()
 
+    def replay(self, oplog):
+
+        t0_ = time.time()
+        size = 0
+        pending = 0
+        entry = None
+        # includes reading the slice if it is streamed, and checkpoints
+        with self._timer.time('apply'):
+            for entry in oplog:
+                # TODO: log excep
+                self.docman.process(entry)
+                size += 1
+                pending += 1
+                if (pending >= self._checkpoint_entries or
+                        time.time() - self._last_checkpoint >=
+                        self._checkpoint_seconds):
+                    self.checkpoint(entry['ts'])
+                    pending = 0
+
+        if entry is not None:
+            self._last_ts = entry['ts']
+        self.checkpoint(self._last_ts)
+        elapsed = time.time() - t0_
+
+        SLICES.inc(process='replay')
+        ENTRIES.inc(size, process='replay')
+        REPLAY_LAG.set(time.time() - self._last_ts.time,
+                       target=self.lag_label)
+
+        if self.lag_window is not None:
+            self.lag_window.advance()
+
+        stats = self.docman.stats()
+        if self.slice_cache is not None:
+            stats = '{}, {}'.format(stats, self.slice_cache.stats())
+        LOG.info('Replayed size={} in {:.3f} secs, {:.0f} ops/sec ({})'.format(
+            size, elapsed, size / max(elapsed, 1e-6), stats))
         LOG.info('Current progress={}'.format(ts2localtime(self._last_ts)))
+        LOG.info('Stage timings: {}'.format(self._timer.summary()))
 
     def run(self):
         try:
+            if self._prefetch_depth > 0 and self.slice_cache is None:
+                self._prefetcher = SlicePrefetcher(
+                    self._oplog_store, self._last_ts,
+                    depth=self._prefetch_depth,
+                    max_bytes=conf.get('replay_prefetch_max_bytes', 0),
+                    timer=self._timer)
+                self._prefetcher.start()
+
             while self._running:
                 LOG.info('Loading ts={}, last progress={}'.format(
                     self._last_ts, ts2localtime(self._last_ts)))
@@ -120,19 +312,29 @@ class OplogReplay(object):
 
                 if oplog is None:
                     LOG.info('Loaded None. No more oplog to sync.')
-                    time.sleep(10)
+                    if self._prefetcher is None:
+                        # prefetcher already waited in `get`
+                        self.wait_for_slice(10)
                 else:
-                    LOG.info('Loaded ts={}, size={}'.format(
-                        self._last_ts, len(oplog)))
+                    LOG.info('Loaded ts={}'.format(self._last_ts))
                     self.replay(oplog)
         except Exception as e:
             LOG.error(str(e), exc_info=True)
+        finally:
+            self._running = False
+            if self.lag_window is not None:
+                self.lag_window.leave(self)
+            if self._prefetcher is not None:
+                self._prefetcher.stop()
+            self.docman.close()
+            self.close_stores()
 
         LOG.warning('Oplog syncing stopped.')
 
     def start(self):
         LOG.warning('Oplog syncing starting...')
         self._running = True
+        self.open_stores()
         self._thread = threading.Thread(target=self.run)
         self._thread.start()
         LOG.warning('Started pid={}, syncing thread={}'.format(
@@ -143,52 +345,212 @@ class OplogReplay(object):
         LOG.warning('Would stop as soon as current slice syncing completes.')
 
 
+class MergedOplogReplay(OplogReplay):
+    """
+    Replay the slice streams of several `sources` as one, merged by ts.
+
+    Entries are only applied up to the watermark, the lowest ts every
+    stream is known to be complete through, i.e. its last loaded slice, or
+    its capture progress once no slice is left. Each round loads at most
+    one slice per stream, so about one slice per stream is buffered, and a
+    single checkpoint covers all streams.
+    """
+
+    def __init__(self, sources, start=None):
+        super().__init__(start)
+
+        self._sources = [source['name'] for source in sources]
+        self._stores = {name: OplogStore(source=name)
+                        for name in self._sources}
+        self._buffers = {name: collections.deque() for name in self._sources}
+        self._loaded_ts = {name: self._last_ts for name in self._sources}
+        # stream holding back the watermark when nothing was left to merge,
+        # and the watermark
+        self._holding = None
+
+        # slices of different streams are merged entry by entry
+        self._prefetch_depth = 0
+        self._streaming = False
+
+    def _known_ts(self, name):
+        """
+        Load the next slice of a drained stream, ts the stream is complete
+        through
+        """
+        oplog_store = self._stores[name]
+        buf = self._buffers[name]
+        if buf:
+            return self._loaded_ts[name]
+
+        # read before looking for slices, which may be saved in between
+        captured_ts = oplog_store.captured_ts()
+        slice_name = oplog_store.next_slice_name(self._loaded_ts[name])
+        if slice_name is None:
+            return max(self._loaded_ts[name], captured_ts)
+
+        self.check_filter(slice_name, oplog_store)
+        with self._timer.time('fetch'):
+            data = oplog_store.fetch(slice_name)
+        with self._timer.time('decode'):
+            buf.extend(entry for entry in oplog_store.decode(data)
+                       if entry['ts'] > self._last_ts)
+        self._loaded_ts[name] = slice_name_to_ts(slice_name)
+        return self._loaded_ts[name]
+
+    def load_oplog(self):
+
+        def take(buf, watermark):
+            while buf and buf[0]['ts'] <= watermark:
+                yield buf.popleft()
+
+        oplog = []
+        watermark = self._last_ts
+        # the watermark may advance past idle streams without any entry
+        while not oplog:
+            known = {name: self._known_ts(name) for name in self._sources}
+            holding = min(self._sources, key=known.get)
+            known_ts = known[holding]
+            if known_ts <= watermark:
+                self._holding = holding, watermark
+                return None
+            watermark = known_ts
+            oplog = list(heapq.merge(
+                *(take(self._buffers[name], watermark)
+                  for name in self._sources),
+                key=lambda entry: entry['ts']))
+
+        if self._compact:
+            with self._timer.time('compact'):
+                oplog = compact(oplog, self._unique_indexes)
+        LOG.info('Merged {} entries up to watermark={}'.format(
+            len(oplog), watermark))
+        return oplog
+
+    def wait_for_slice(self, timeout):
+        """
+        Wait for the stream holding back the watermark, which has no entries
+        buffered, to save a slice or, if idle, to mark its capture progress
+        past the watermark, polling the latter with exponential backoff
+        """
+        if self._holding is None:
+            return True
+        name, watermark = self._holding
+        oplog_store = self._stores[name]
+
+        deadline = time.time() + timeout
+        interval = slice_poll_min_interval
+        while True:
+            if oplog_store.captured_ts() > watermark:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if oplog_store.wait_for_slice(
+                    self._loaded_ts[name], min(interval, remaining)):
+                return True
+            interval = min(interval * 2, slice_poll_max_interval)
+
+    def make_oplog_store(self, source):
+        # each stream has its own
+        return None
+
+    def open_stores(self):
+        for oplog_store in self._stores.values():
+            oplog_store.open()
+
+    def close_stores(self):
+        for oplog_store in self._stores.values():
+            oplog_store.close()
+
+
+class MultiSourceReplay(object):
+    """
+    Replay each of `sources` independently, e.g. shards whose collections
+    do not overlap in the target
+    """
+
+    def __init__(self, sources, start=None):
+        self._replays = [OplogReplay(start, source=source['name'])
+                         for source in sources]
+
+    def is_running(self):
+        return all(op.is_running() for op in self._replays)
+
+    def start(self):
+        for op in self._replays:
+            op.start()
+
+    def safe_stop(self):
+        for op in self._replays:
+            op.safe_stop()
+
+
+def command_calls(client, entry, ns_filter):
+    """
+    Driver calls applying command `entry` to `client` as
+    `(method, args, kwargs)`, the result of each is sent back. Shared by
+    the threaded and asyncio engines, which only differ in awaiting them.
+    """
+    doc = entry['o']
+    db_name = entry['ns'].split('.', 1)[0]
+
+    if doc.get('dropDatabase'):
+        if ns_filter.whitelist or ns_filter.blacklist:
+            # the rest of the target database is not ours to drop
+            db = client[db_name]
+            colls = yield db.list_collection_names, (), {}
+            for coll in colls:
+                if ns_filter.should_sync('{}.{}'.format(db_name, coll)):
+                    yield db.drop_collection, (coll,), {}
+        else:
+            yield client.drop_database, (db_name,), {}
+
+    if doc.get('renameCollection'):
+        a = doc['renameCollection']
+        b = doc['to']
+        if a and b:
+            # entries of the target namespace are filtered afterwards
+            if ns_filter.should_sync(a):
+                yield client.admin.command, ('renameCollection', a), {'to': b}
+
+    if doc.get('create'):
+        ns = '{}.{}'.format(db_name, doc['create'])
+        if db_name and ns_filter.should_sync(ns):
+            yield client[db_name].command, (SON(doc),), {}
+
+    if doc.get('drop'):
+        coll = doc['drop']
+        ns = '{}.{}'.format(db_name, coll)
+        if db_name and ns_filter.should_sync(ns):
+            yield client[db_name].drop_collection, (coll,), {}
+
+
+def partition_of(entry, num_partitions):
+    # all entries of a document fall in the same partition
+    return hash((entry['ns'], repr(get_doc_id(entry)))) % num_partitions
+
+
 class DocManager(object):
 
-    def __init__(self):
-        self.mongo = pymongo.MongoClient(conf['dst_url'])
+    def __init__(self, client=None):
+        if client is None:
+            client = pymongo.MongoClient(conf['dst_url'])
+        self.mongo = client
         self._whitelist = conf['whitelist']
         self._blacklist = conf['blacklist']
 
-        if self._whitelist:
-            self._whitelist_regex = []
-            for ns in self._whitelist:
-                ns_regex = namespace_to_regex(ns)
-                self._whitelist_regex.append(ns_regex)
-
-            self._should_sync = self.is_in_whitelist
-        elif self._blacklist:
-            self._should_sync = self.skip_blacklist
-            self._blacklist_regex = []
-            for ns in self._blacklist:
-                ns_regex = namespace_to_regex(ns)
-                self._blacklist_regex.append(ns_regex)
-        else:
-            self.should_sync = lambda x: True
+        self._ns_filter = NamespaceFilter(
+            self._whitelist, self._blacklist,
+            cache_size=conf.get('ns_filter_cache_size', 10000))
 
         LOG.info('Whitelist: {}, blacklist: {}'.format(
             self._whitelist, self._blacklist))
 
-    def is_in_whitelist(self, entry):
-        for regex in self._whitelist_regex:
-            if regex.match(entry['ns']):
-                return True
-        return False
-
-    def skip_blacklist(self, entry):
-        for regex in self._blacklist_regex:
-            if regex.match(entry['ns']):
-                return True
-        return True
+        self.num_requests = 0
+        self.num_round_trips = 0
 
     def should_sync(self, entry):
-        db, coll = entry['ns'].split('.', 1)
-        # ignore system.indexes
-        if coll.startswith("system."):
-            return False
-        if coll == "$cmd":
-            return True
-        return self._should_sync(entry)
+        return self._ns_filter.should_sync(entry['ns'])
 
     def process(self, entry):
 
@@ -196,6 +558,7 @@ class DocManager(object):
             return
 
         operation = entry['op']
+        APPLIED_OPS.inc(op=operation)
 
         # Remove
         if operation == 'd':
@@ -216,6 +579,20 @@ class DocManager(object):
             except pymongo.errors.OperationFailure as e:
                 LOG.warning('Command failed: {}'.format(e))
 
+    def flush(self):
+        """
+        Apply any buffered writes, no-op for per-entry replay
+        """
+        pass
+
+    def stats(self):
+        return 'requests={}, round trips={}, {}'.format(
+            self.num_requests, self.num_round_trips,
+            self._ns_filter.stats())
+
+    def close(self):
+        pass
+
     def insert(self, entry):
         doc = entry['o']
         ns = entry['ns']
@@ -223,6 +600,8 @@ class DocManager(object):
         self.mongo[db_name][coll_name].replace_one(
             {'_id': doc['_id']},
             doc, upsert=True)
+        self.num_requests += 1
+        self.num_round_trips += 1
 
     def update(self, entry):
 
@@ -238,6 +617,8 @@ class DocManager(object):
                  ('update', doc),
                  ('new', True)]),
             allowable_errors=[no_obj_error])['value']
+        self.num_requests += 1
+        self.num_round_trips += 1
         return updated
 
     def remove(self, entry):
@@ -248,29 +629,179 @@ class DocManager(object):
 
         self.mongo[db_name][coll_name].delete_one(
             {'_id': doc['_id']})
+        self.num_requests += 1
+        self.num_round_trips += 1
 
+    @timeit('command')
     def handle_command(self, entry):
+        calls = command_calls(self.mongo, entry, self._ns_filter)
+        result = None
+        while True:
+            try:
+                method, args, kwargs = calls.send(result)
+            except StopIteration:
+                return
+            result = method(*args, **kwargs)
+
+
+class BulkDocManager(DocManager):
+    """
+    Group consecutive CRUD entries per namespace into ordered `bulk_write`
+    batches; commands flush every pending batch before being applied
+    """
+
+    def __init__(self, client=None, batch_size=None, flush_interval=None):
+        super().__init__(client)
+        self._batch_size = batch_size or conf.get('bulk_batch_size', 1000)
+        # seconds a buffered write may wait before being flushed
+        self._flush_interval = flush_interval or conf.get(
+            'bulk_flush_interval', 1)
 
-        # TODO: filter by blacklist/whitelist
+        self._buffers = {}
+        self._buffered_since = None
+
+        LOG.info('Bulk replay, batch size={}, flush interval={}s'.format(
+            self._batch_size, self._flush_interval))
+
+    def process(self, entry):
+        # commands act as barriers
+        if entry['op'] == 'c':
+            self.flush()
+
+        super().process(entry)
+
+        if (self._buffered_since is not None and
+                time.time() - self._buffered_since >= self._flush_interval):
+            self.flush()
+
+    def _add(self, ns, request):
+        buf = self._buffers.setdefault(ns, [])
+        buf.append(request)
+        if self._buffered_since is None:
+            self._buffered_since = time.time()
+        if len(buf) >= self._batch_size:
+            self._flush_ns(ns)
+
+    def _flush_ns(self, ns):
+        requests = self._buffers.pop(ns, None)
+        if not requests:
+            return
+        db_name, coll_name = ns.split('.', 1)
+        self.mongo[db_name][coll_name].bulk_write(requests, ordered=True)
+        self.num_requests += len(requests)
+        self.num_round_trips += 1
+
+    def flush(self):
+        for ns in list(self._buffers):
+            self._flush_ns(ns)
+        self._buffered_since = None
+
+    def insert(self, entry):
+        doc = entry['o']
+        self._add(entry['ns'],
+                  ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+
+    def update(self, entry):
+        _id = entry['o2']['_id']
         doc = entry['o']
-        if doc.get('dropDatabase'):
-            db_name = entry['ns'].split('.', 1)[0]
-            self.mongo.drop_database(db_name)
-
-        if doc.get('renameCollection'):
-            a = doc['renameCollection']
-            b = doc['to']
-            if a and b:
-                self.mongo.admin.command(
-                    "renameCollection", a, to=b)
-
-        if doc.get('create'):
-            new_db, coll = doc['idIndex']['ns'].split('.', 1)
-            if new_db:
-                self.mongo[new_db].command(SON(doc))
-
-        if doc.get('drop'):
-            db_name = entry['ns'].split('.', 1)[0]
-            coll = doc['drop']
-            if db_name:
-                self.mongo[db_name].drop_collection(coll)
+        if any(k.startswith('$') for k in doc):
+            request = UpdateOne({'_id': _id}, doc)
+        else:
+            # full document replacement
+            request = ReplaceOne({'_id': _id}, doc)
+        self._add(entry['ns'], request)
+
+    def remove(self, entry):
+        doc = entry['o']
+        self._add(entry['ns'], DeleteOne({'_id': doc['_id']}))
+
+
+class PartitionedApplier(object):
+    """
+    Apply oplog entries concurrently with N workers, each owning a hash
+    partition of `(ns, _id)`, so that per-document ordering is preserved.
+
+    Commands are global barriers: all workers are drained before a command
+    is applied. `flush` returns only after every worker has applied all
+    entries handed over so far, the caller may then advance its tag.
+    """
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, num_workers, docman_factory, queue_size=10000):
+        self._num_workers = num_workers
+        self._docmans = [docman_factory() for _ in range(num_workers)]
+        self._queues = [queue.Queue(maxsize=queue_size)
+                        for _ in range(num_workers)]
+        self._errors = []
+
+        self._threads = []
+        for i in range(num_workers):
+            t = threading.Thread(target=self._work, args=(i,),
+                                 name='replay-worker-{}'.format(i),
+                                 daemon=True)
+            t.start()
+            self._threads.append(t)
+
+        LOG.info('Parallel replay, workers={}'.format(num_workers))
+
+    def _work(self, i):
+        q = self._queues[i]
+        docman = self._docmans[i]
+        while True:
+            entry = q.get()
+            try:
+                if entry is self._STOP:
+                    break
+                # skip remaining entries once any worker failed
+                if self._errors:
+                    continue
+                if entry is self._FLUSH:
+                    docman.flush()
+                else:
+                    docman.process(entry)
+            except Exception as e:
+                LOG.error('Worker {} failed: {}'.format(i, e), exc_info=True)
+                self._errors.append(e)
+            finally:
+                q.task_done()
+
+    def _check_errors(self):
+        if self._errors:
+            raise Exception('Parallel replay failed: {}'.format(
+                self._errors[0]))
+
+    def partition(self, entry):
+        return partition_of(entry, self._num_workers)
+
+    def process(self, entry):
+        self._check_errors()
+
+        if entry['op'] not in ('i', 'u', 'd'):
+            self.flush()
+            # workers are idle now, safe to borrow one
+            self._docmans[0].process(entry)
+            return
+
+        self._queues[self.partition(entry)].put(entry)
+
+    def flush(self):
+        for q in self._queues:
+            q.put(self._FLUSH)
+        for q in self._queues:
+            q.join()
+        self._check_errors()
+
+    def stats(self):
+        return 'requests={}, round trips={}, workers={}, ' \
+            'filter hits={}, misses={}'.format(
+                sum(d.num_requests for d in self._docmans),
+                sum(d.num_round_trips for d in self._docmans),
+                self._num_workers,
+                sum(d._ns_filter.hits for d in self._docmans),
+                sum(d._ns_filter.misses for d in self._docmans))
+
+    def close(self):
+        for q in self._queues:
+            q.put(self._STOP)
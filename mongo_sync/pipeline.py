@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import queue
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from bson.raw_bson import RawBSONDocument
+
+from mongo_sync.mongo_store import encode_slice
+from mongo_sync.utils import slice_name_to_ts, entry_size, StageTimer
+
+LOG = logging.getLogger('oplog_replay')
+DUMP_LOG = logging.getLogger('oplog_dump')
+
+
+class SlicePrefetcher(object):
+    """
+    Fetch and decode the next slices in background while the current one
+    is being applied.
+
+    At most `depth` decoded slices are queued, and no more slices are
+    fetched once queued slices take `max_bytes` (decoded BSON size, often
+    several times the fetched one), unless the queue is empty.
+    """
+
+    def __init__(self, oplog_store, last_ts, depth=2, max_bytes=0,
+                 timer=None, poll_interval=10):
+        self._oplog_store = oplog_store
+        self._next_ts = last_ts
+        self._depth = depth
+        self._max_bytes = max_bytes
+        self._timer = timer or StageTimer()
+        self._poll_interval = poll_interval
+
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._cond = threading.Condition()
+        self._error = None
+        self._running = False
+
+    def _has_room(self):
+        if not self._queue:
+            return True
+        if len(self._queue) >= self._depth:
+            return False
+        if self._max_bytes and self._queued_bytes >= self._max_bytes:
+            return False
+        return True
+
+    def _time(self, stage):
+        return self._timer.time(stage)
+
+    def _run(self):
+        try:
+            while self._running:
+                with self._cond:
+                    while self._running and not self._has_room():
+                        self._cond.wait()
+                if not self._running:
+                    break
+
+                name = self._oplog_store.next_slice_name(self._next_ts)
+                if name is None:
+                    self._oplog_store.wait_for_slice(
+                        self._next_ts, self._poll_interval)
+                    continue
+
+                with self._time('fetch'):
+                    data = self._oplog_store.fetch(name)
+                with self._time('decode'):
+                    oplog = self._oplog_store.decode(data)
+                    # free for raw BSON entries
+                    size = sum(entry_size(entry) for entry in oplog)
+
+                with self._cond:
+                    self._queue.append((name, oplog, size))
+                    self._queued_bytes += size
+                    self._cond.notify_all()
+
+                self._next_ts = slice_name_to_ts(name)
+        except Exception as e:
+            LOG.error('Prefetching failed: {}'.format(e), exc_info=True)
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Pop the next decoded slice as (name, oplog), None on timeout
+        """
+        with self._cond:
+            if not self._queue and self._error is None:
+                self._cond.wait(timeout)
+            if self._error is not None and not self._queue:
+                raise Exception('Prefetching failed: {}'.format(self._error))
+            if not self._queue:
+                return None
+            name, oplog, size = self._queue.popleft()
+            self._queued_bytes -= size
+            self._cond.notify_all()
+        return name, oplog
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='prefetch',
+                                        daemon=True)
+        self._thread.start()
+        LOG.info('Prefetching started, depth={}, max bytes={}'.format(
+            self._depth, self._max_bytes))
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+
+class DumpPipeline(object):
+    """
+    Overlap oplog reading, slice encoding and upload.
+
+    The dumping thread reads and hands each slice to `submit`, slices are
+    encoded on a pool (threads, or `processes` worker processes) and
+    uploaded by one thread in submission order, so the last saved slice
+    stays a valid resume point. At most `queue_size` slices are in flight
+    before `submit` blocks. Capture progress is recorded by the upload
+    thread too, once every slice before it is uploaded.
+    """
+
+    _STOP = object()
+    _MARK = object()
+
+    def __init__(self, oplog_store, fmt, codec=None, processes=0,
+                 queue_size=4, timer=None):
+        self._oplog_store = oplog_store
+        self._fmt = fmt
+        self._codec = codec
+        self._processes = processes
+        self._timer = timer or StageTimer()
+
+        if processes > 0:
+            self._executor = ProcessPoolExecutor(processes)
+        else:
+            self._executor = ThreadPoolExecutor(1)
+
+        self._uploads = queue.Queue(maxsize=queue_size)
+        self._error = None
+
+        self._thread = threading.Thread(target=self._upload,
+                                        name='dump-upload', daemon=True)
+        self._thread.start()
+
+        DUMP_LOG.info('Dump pipeline started, encode processes={}, '
+                      'queue size={}'.format(processes, queue_size))
+
+    def _encode(self, sliced):
+        if self._processes > 0:
+            # RawBSONDocument is handed over to worker processes as bytes
+            sliced = [e.raw if isinstance(e, RawBSONDocument) else e
+                      for e in sliced]
+        return self._executor.submit(encode_slice, self._fmt, sliced,
+                                     self._codec)
+
+    def _upload(self):
+        while True:
+            item = self._uploads.get()
+            try:
+                if item is self._STOP:
+                    break
+                if self._error is not None:
+                    continue
+                if item[0] is self._MARK:
+                    self._oplog_store.mark_captured(item[1])
+                    continue
+                last_ts, start_ts, count, future = item
+                with self._timer.time('encode_wait'):
+                    data = future.result()
+                # upload latency is recorded by the store
+                self._oplog_store.put_slice(last_ts, data, start_ts, count)
+                DUMP_LOG.info('Uploaded size={}, bytes={}, ts={}'.format(
+                    count, len(data), last_ts))
+            except Exception as e:
+                DUMP_LOG.error('Upload failed: {}'.format(e), exc_info=True)
+                self._error = e
+            finally:
+                self._uploads.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise Exception('Dump pipeline failed: {}'.format(self._error))
+
+    def submit(self, sliced):
+        self._check_error()
+        future = self._encode(sliced)
+        # blocks the reader while uploads lag behind
+        with self._timer.time('backpressure'):
+            self._uploads.put(
+                (sliced[-1]['ts'], sliced[0]['ts'], len(sliced), future))
+
+    def mark_captured(self, ts):
+        self._check_error()
+        self._uploads.put((self._MARK, ts))
+
+    def close(self):
+        """
+        Wait until every submitted slice is uploaded
+        """
+        self._uploads.put(self._STOP)
+        self._thread.join()
+        self._executor.shutdown()
+        DUMP_LOG.info('Dump pipeline closed, stage timings: {}'.format(
+            self._timer.summary()))
+        self._check_error()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+import time
+import threading
+import logging
+
+from mongo_sync.utils import dt2ts
+from mongo_sync.store import OplogStore
+from mongo_sync.config import conf
+
+LOG = logging.getLogger('oplog_dump')
+
+
+class RetentionWorker(object):
+    """
+    Remove slices older than `keep_days`, and the oldest slices while the
+    store holds more than `keep_bytes`.
+
+    Slices are removed in batches of `retention_batch_size`, with at least
+    `retention_batch_interval` seconds between batches.
+    """
+
+    def __init__(self, oplog_store=None):
+        self._oplog_store = oplog_store or OplogStore()
+
+        self._keep_days = conf['keep_days']
+        self._keep_bytes = conf.get('keep_bytes', 0)
+        self._batch_size = conf.get('retention_batch_size', 100)
+        self._batch_interval = conf.get('retention_batch_interval', 1)
+        self._check_interval = conf.get('retention_check_interval', 60)
+
+        self._running = False
+
+    def is_running(self):
+        if not self._running:
+            return False
+        if not self._thread.is_alive():
+            return False
+        return True
+
+    def expire_ts(self):
+        expire_date = datetime.date.today() - datetime.timedelta(
+            days=self._keep_days)
+        return dt2ts(datetime.datetime.combine(expire_date, datetime.time()))
+
+    def find_expired(self):
+        names = self._oplog_store.list_expired(
+            self.expire_ts(), limit=self._batch_size)
+        if names or not self._keep_bytes:
+            return names
+
+        excess = self._oplog_store.total_bytes() - self._keep_bytes
+        names = []
+        if excess > 0:
+            for name, size in self._oplog_store.list_oldest(self._batch_size):
+                names.append(name)
+                excess -= size
+                if excess <= 0:
+                    break
+        return names
+
+    def run(self):
+        try:
+            while self._running:
+                names = self.find_expired()
+                if not names:
+                    time.sleep(self._check_interval)
+                    continue
+
+                self._oplog_store.remove_many(names)
+                LOG.info('Removed {} slices, {} to {}'.format(
+                    len(names), names[0], names[-1]))
+                time.sleep(self._batch_interval)
+        except Exception as e:
+            LOG.error(str(e), exc_info=True)
+        finally:
+            self._oplog_store.close()
+
+        LOG.warning('Retention worker stopped.')
+
+    def start(self):
+        self._running = True
+        self._oplog_store.open()
+        self._thread = threading.Thread(target=self.run, name='retention',
+                                        daemon=True)
+        self._thread.start()
+        LOG.warning('Started pid={}, retention thread={}'.format(
+            os.getpid(), self._thread.ident))
+
+    def safe_stop(self):
+        self._running = False
@@ -1,19 +1,80 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import json
+import stat
+import time
+import mmap
+import bisect
+import hashlib
+import threading
 import datetime
 import logging
-import pickle
 
+import pymongo
 from bson import Timestamp
 
-from mongo_sync.mongo_store import MongoStore
+from bson import ObjectId
+
+from mongo_sync.mongo_store import (MongoStore, SERIALIZERS, ConnectionCounter,
+                                    RawBSONWriter, serializer, encode_slice)
+from mongo_sync.metrics import SLICE_BYTES
+from mongo_sync import codecs
 
 from mongo_sync.utils import (timeit, dt2ts, ts_to_slice_name,
-                              slice_name_to_ts, namespace_to_regex)
+                              slice_name_to_ts, namespace_to_regex,
+                              entry_size)
 
 from mongo_sync.config import conf
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+LOG = logging.getLogger('oplog_store')
+
+
+class SliceWriter(object):
+    """
+    Collect entries of one slice, which is handed over to `save` on commit.
+
+    Stores that can encode and upload entries as they come subclass this,
+    a slice only becomes visible once committed.
+    """
+
+    def __init__(self, save=None):
+        self._save = save
+        self.entries = []
+        self.count = 0
+        self.num_bytes = 0
+        self.start_ts = None
+        self.last_ts = None
+
+    def write(self, entry):
+        self.entries.append(entry)
+        self._track(entry)
+
+    def _track(self, entry):
+        if self.start_ts is None:
+            self.start_ts = entry['ts']
+        self.last_ts = entry['ts']
+        self.count += 1
+        # decoded entries would be encoded to be sized, only done for the
+        # byte limit
+        if slice_max_bytes or hasattr(entry, 'raw'):
+            self.num_bytes += entry_size(entry)
+
+    def commit(self):
+        self._save(self.entries)
+        self.entries = []
+
+    def abort(self):
+        self.entries = []
+
 
 class OplogStore(object):
     """
@@ -24,89 +85,610 @@ class OplogStore(object):
     oplog切片命名规则：Timstamp.time_Timstamp.inc (切片末尾时间戳)
     """
 
+    # spec of the dump-side filter slices are written with, None if not any
+    dump_filter = None
+
+    def open(self):
+        """
+        Acquire long-lived resources, called when dump/replay starts
+        """
+        pass
+
+    def close(self):
+        """
+        Release resources acquired by `open`
+        """
+        pass
+
     def list_names(self):
         raise NotImplementedError
 
+    def list_expired(self, before_ts, limit=0):
+        """
+        Names of slices ending before `before_ts`, oldest first
+        """
+        names = [n for n in self.list_names()
+                 if slice_name_to_ts(n) < before_ts]
+        if limit:
+            names = names[:limit]
+        return names
+
+    def list_oldest(self, limit):
+        """
+        (name, bytes) of the oldest slices
+        """
+        raise NotImplementedError
+
+    def total_bytes(self):
+        raise NotImplementedError
+
     def remove(self):
         raise NotImplementedError
 
+    def remove_many(self, slice_names):
+        for name in slice_names:
+            self.remove(name)
+
     def get_last_saved_ts(self):
         raise NotImplementedError
 
-    def load_oplog(self, last_ts):
+    def mark_captured(self, ts):
+        """
+        Record the source has been captured through `ts` though no slice
+        ends there, so that merged replay may advance past idle sources
+        """
+        pass
+
+    def captured_ts(self):
+        """
+        ts the source has been captured through
+        """
+        return self.get_last_saved_ts()
+
+    def next_slice_name(self, last_ts):
+        """
+        Name of the first slice ending after `last_ts`, None if not any
+        """
+        raise NotImplementedError
+
+    def wait_for_slice(self, after_ts, timeout):
+        """
+        Block until a slice ending after `after_ts` is saved, for at most
+        `timeout` seconds, False if none was.
+
+        Polls with exponential backoff, stores able to watch for new slices
+        override it.
+        """
+        deadline = time.time() + timeout
+        interval = slice_poll_min_interval
+        while True:
+            if self.next_slice_name(after_ts) is not None:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, slice_poll_max_interval)
+
+    def fetch(self, slice_name):
+        """
+        Serialized bytes of a slice
+        """
         raise NotImplementedError
 
-    def dump_oplog(self, ts):
+    def slice_filter(self, slice_name):
+        """
+        Dump-side filter spec a slice was written with, None if unfiltered
+        or unknown
+        """
+        return None
+
+    def decode(self, data):
+        return serializer.deserialize(data, allow_pickle=allow_pickle)
+
+    def stream(self, slice_name):
+        """
+        Yield entries of a slice incrementally
+        """
+        yield from self.decode(self.fetch(slice_name))
+
+    def load_oplog(self, last_ts):
+        name = self.next_slice_name(last_ts)
+        if name is None:
+            return None
+        return self.decode(self.fetch(name))
+
+    def put_slice(self, last_ts, data, start_ts, count):
+        """
+        Save an already serialized slice
+        """
         raise NotImplementedError
 
+    def open_slice_writer(self):
+        """
+        `SliceWriter` streaming entries into the store, None if unsupported
+        """
+        return None
+
+    def dump_oplog(self, last_ts, oplog):
+        data = encode_slice(slice_format, oplog, slice_codec)
+        self.put_slice(last_ts, data, oplog[0]['ts'], len(oplog))
+
 
 store_url = conf['oplog_store_url']
 
 oplog_store_db = conf['oplog_store_db']
 
+# `raw_bson` or legacy `pickle`, both formats can be read
+slice_format = conf.get('slice_format', 'pickle')
+
+# compression of `raw_bson` slices, see `mongo_sync.codecs`
+if conf.get('zstd_dict_path'):
+    codecs.load_dictionary(conf['zstd_dict_path'])
+slice_codec = codecs.get_codec(conf.get('slice_codec'),
+                               level=conf.get('slice_codec_level'))
+
+
+def codec_id(fmt):
+    if fmt == 'raw_bson':
+        return slice_codec.id
+    return SERIALIZERS[fmt].CODEC.decode()
+
+
+# legacy pickle slices are only loaded if allowed
+allow_pickle = conf.get('allow_pickle_slices', True)
+
+slice_max_bytes = conf.get('slice_max_bytes', 0)
+
+# `pymongo.MongoClient` options, e.g. maxPoolSize, socketTimeoutMS
+pool_options = conf.get('oplog_store_pool') or {}
+
+# backoff of `wait_for_slice` polling, also the longest a watching store
+# waits before checking again in case a notification was missed
+slice_poll_min_interval = conf.get('slice_poll_min_interval', 0.1)
+slice_poll_max_interval = conf.get('slice_poll_max_interval', 10)
+
 
 class MongoOplogStore(OplogStore):
+    """
+    Slices are saved in GridFS, and indexed by a manifest collection of
+
+        {_id: name, start_ts, end_ts, count, bytes, format, codec, filter}
+
+    A slice is written to GridFS before its manifest entry and removed
+    after it, so every manifest entry refers to a complete slice.
+
+    Slices of `source` are kept in bucket `fs_<source>` and manifest
+    `slice_manifest_<source>`.
+    """
+
+    manifest_name = 'slice_manifest'
+    bucket_name = 'fs'
+    progress_name = 'capture_progress'
+    # filename prefix of slices being streamed
+    pending_prefix = 'pending.'
+
+    _ready_manifests = set()
+
+    def __init__(self, source=None):
+        self.source = source
+        if source is not None:
+            self.manifest_name = '{}_{}'.format(self.manifest_name, source)
+            self.bucket_name = '{}_{}'.format(self.bucket_name, source)
+
+        self._store = None
+        self._store_lock = threading.Lock()
+        self._connections = ConnectionCounter()
+
+        # change streams need the store to be a replica set
+        self._watch_supported = True
+        self._pending_purged = False
+
+    @property
+    def connections_opened(self):
+        return self._connections.opened
+
+    def open(self):
+        with self._store_lock:
+            if self._store is None:
+                self._store = MongoStore(
+                    store_url, oplog_store_db, allow_pickle,
+                    collection=self.bucket_name,
+                    event_listeners=[self._connections], **pool_options)
+
+    def close(self):
+        with self._store_lock:
+            if self._store is None:
+                return
+            self._store.close()
+            self._store = None
+            LOG.info('Oplog store closed, connections opened={}'.format(
+                self.connections_opened))
+
+    def _get_store(self):
+        # opened lazily if used before `open`
+        store = self._store
+        if store is None:
+            self.open()
+            store = self._store
+        return store
+
+    def _manifest(self, store):
+        manifest = store.db[self.manifest_name]
+        if self.manifest_name not in MongoOplogStore._ready_manifests:
+            manifest.create_index([('end_ts', pymongo.ASCENDING)],
+                                  unique=True)
+            if manifest.find_one() is None:
+                self._backfill_manifest(store, manifest)
+            MongoOplogStore._ready_manifests.add(self.manifest_name)
+        return manifest
+
+    def _backfill_manifest(self, store, manifest):
+        # slices saved before the manifest existed, sized for retention
+        files = store.db[store.collection + '.files'].find(
+            {}, {'filename': 1, 'length': 1})
+        names = []
+        for doc in files:
+            name = doc['filename']
+            if name.startswith(self.pending_prefix):
+                continue
+            manifest.replace_one(
+                {'_id': name},
+                {'end_ts': slice_name_to_ts(name), 'bytes': doc['length']},
+                upsert=True)
+            names.append(name)
+        if names:
+            LOG.warning(
+                'Backfilled manifest with {} slices'.format(len(names)))
 
     def list_names(self):
-        with MongoStore(store_url, oplog_store_db) as store:
-            slice_names = store.list()
+        store = self._get_store()
+        manifest = self._manifest(store)
+        slice_names = [doc['_id'] for doc in manifest.find(
+            {}, {'_id': 1}, sort=[('end_ts', pymongo.ASCENDING)])]
         return slice_names
 
+    def list_expired(self, before_ts, limit=0):
+        store = self._get_store()
+        manifest = self._manifest(store)
+        slice_names = [doc['_id'] for doc in manifest.find(
+            {'end_ts': {'$lt': before_ts}}, {'_id': 1},
+            sort=[('end_ts', pymongo.ASCENDING)], limit=limit)]
+        return slice_names
+
+    def list_oldest(self, limit):
+        store = self._get_store()
+        return [(doc['_id'], doc.get('bytes', 0))
+                for doc in self._manifest(store).find(
+                    {}, {'bytes': 1},
+                    sort=[('end_ts', pymongo.ASCENDING)], limit=limit)]
+
+    def total_bytes(self):
+        store = self._get_store()
+        ret = list(self._manifest(store).aggregate(
+            [{'$group': {'_id': None, 'bytes': {'$sum': '$bytes'}}}]))
+        return ret[0]['bytes'] if ret else 0
+
     def remove(self, slice_name):
-        with MongoStore(store_url, oplog_store_db) as store:
-            store.delete(slice_name)
+        store = self._get_store()
+        self._manifest(store).delete_one({'_id': slice_name})
+        store.delete(slice_name)
+
+    def remove_many(self, slice_names):
+        store = self._get_store()
+        self._manifest(store).delete_many({'_id': {'$in': slice_names}})
+        store.delete_many(slice_names)
 
     def get_last_saved_ts(self):
 
-        with MongoStore(store_url, oplog_store_db) as store:
-            slices = store.list()
-            if not slices:
-                return Timestamp(
-                    int(datetime.datetime(1970, 1, 2).timestamp()), 0)
+        store = self._get_store()
+        last = self._manifest(store).find_one(
+            sort=[('end_ts', pymongo.DESCENDING)])
+        if last is None:
+            return Timestamp(
+                int(datetime.datetime(1970, 1, 2).timestamp()), 0)
 
-            last_slice = max(slices)
-            time, inc = last_slice.split('_')
-            last_ts = Timestamp(int(time), int(inc))
+        last_ts = last['end_ts']
 
         return last_ts
 
-    def load_oplog(self, last_ts):
+    def mark_captured(self, ts):
+        self._get_store().db[self.progress_name].update_one(
+            {'_id': self.manifest_name}, {'$max': {'ts': ts}}, upsert=True)
 
-        with MongoStore(store_url, oplog_store_db) as store:
+    def captured_ts(self):
+        last_ts = self.get_last_saved_ts()
+        doc = self._get_store().db[self.progress_name].find_one(
+            {'_id': self.manifest_name})
+        if doc is not None and doc['ts'] > last_ts:
+            return doc['ts']
+        return last_ts
 
-            last_name = ts_to_slice_name(last_ts)
-            names = sorted(store.list())
-            cur_name = None
+    def next_slice_name(self, last_ts):
+        store = self._get_store()
+        doc = self._manifest(store).find_one(
+            {'end_ts': {'$gt': last_ts}}, {'_id': 1},
+            sort=[('end_ts', pymongo.ASCENDING)])
+        if doc is None:
+            return None
+        return doc['_id']
+
+    def wait_for_slice(self, after_ts, timeout):
+        """
+        Watch manifest entries with a change stream, polling if the store
+        does not support them
+        """
+        if not self._watch_supported:
+            return super().wait_for_slice(after_ts, timeout)
+
+        deadline = time.time() + timeout
+        manifest = self._manifest(self._get_store())
+        pipeline = [{'$match': {
+            'operationType': {'$in': ['insert', 'replace']},
+            'fullDocument.end_ts': {'$gt': after_ts}}}]
+        try:
+            with manifest.watch(pipeline, max_await_time_ms=int(
+                    min(slice_poll_max_interval, timeout) * 1000)) as stream:
+                # saved before the stream was opened
+                if self.next_slice_name(after_ts) is not None:
+                    return True
+                while time.time() < deadline:
+                    if stream.try_next() is not None:
+                        return True
+            return False
+        except pymongo.errors.OperationFailure as e:
+            LOG.warning('Cannot watch the slice manifest ({}), polling '
+                        'instead'.format(e))
+            self._watch_supported = False
+            return super().wait_for_slice(
+                after_ts, max(0, deadline - time.time()))
+
+    def fetch(self, slice_name):
+        return self._get_store().read_bytes(slice_name)
+
+    def stream(self, slice_name):
+        return self._get_store().read_stream(slice_name)
+
+    @timeit('upload')
+    def put_slice(self, last_ts, data, start_ts, count):
+
+        name = ts_to_slice_name(last_ts)
+
+        store = self._get_store()
+        store.put(name, data, metadata={'format': slice_format,
+                                        'codec': codec_id(slice_format)})
+        self._add_to_manifest(store, name, start_ts, last_ts, count, len(data),
+                              slice_format)
+
+    def _add_to_manifest(self, store, name, start_ts, end_ts, count,
+                         num_bytes, fmt):
+        SLICE_BYTES.inc(num_bytes, kind='compressed')
+        self._manifest(store).replace_one(
+            {'_id': name},
+            {'start_ts': start_ts,
+             'end_ts': end_ts,
+             'count': count,
+             'bytes': num_bytes,
+             'format': fmt,
+             'codec': codec_id(fmt),
+             'filter': self.dump_filter},
+            upsert=True)
+
+    def slice_filter(self, slice_name):
+        doc = self._manifest(self._get_store()).find_one(
+            {'_id': slice_name}, {'filter': 1})
+        if doc is None:
+            return None
+        return doc.get('filter')
+
+    def _purge_pending(self, store):
+        # left by a dump that died before renaming a streamed slice
+        files = store.db[store.collection + '.files']
+        stale = [doc['_id'] for doc in files.find(
+            {'filename': {'$regex': '^' + re.escape(self.pending_prefix)}},
+            {'_id': 1})]
+        for _id in stale:
+            store.fs.delete(_id)
+        if stale:
+            LOG.warning('Removed {} stale pending slices'.format(len(stale)))
+
+    def open_slice_writer(self):
+        if slice_format != 'raw_bson':
+            return None
+        store = self._get_store()
+        if not self._pending_purged:
+            # slices of a source are only streamed by its one dump
+            self._purge_pending(store)
+            self._pending_purged = True
+        return MongoSliceWriter(self, store)
+
+
+class MongoSliceWriter(SliceWriter):
+    """
+    Stream a raw BSON slice into GridFS under a pending filename, renamed
+    and added to the manifest on commit
+    """
 
-            for n in names:
-                if n > last_name:
-                    cur_name = n
-                    break
+    def __init__(self, oplog_store, store):
+        super().__init__()
+        self._oplog_store = oplog_store
+        self._store = store
+        self._grid_in = store.new_file(
+            filename=oplog_store.pending_prefix + str(ObjectId()),
+            metadata={'format': 'raw_bson', 'codec': slice_codec.id})
+        self._writer = RawBSONWriter(self._grid_in, slice_codec)
 
-            if cur_name is None:
-                cur_slice = None
-            else:
-                cur_slice = store.read(cur_name)
+    def write(self, entry):
+        self._writer.write(entry)
+        self._track(entry)
 
-        return cur_slice
+    def commit(self):
+        self._writer.close()
+        self._grid_in.close()
 
-    def dump_oplog(self, last_ts, oplog):
+        name = ts_to_slice_name(self.last_ts)
+        self._store.delete(name)
+        self._store.rename(self._grid_in._id, name)
+        self._oplog_store._add_to_manifest(
+            self._store, name, self.start_ts, self.last_ts, self.count,
+            self._grid_in.length, 'raw_bson')
 
-        with MongoStore(store_url, oplog_store_db) as store:
-            name = '{}_{}'.format(last_ts.time, last_ts.inc)
-            store.write(name, oplog)
+    def abort(self):
+        self._grid_in.abort()
 
 
 class LocalOplogStore(OplogStore):
-    
-    def __init__(self):
+    """
+    Slices are saved as files on a local or shared file system, spread over
+    hashed subdirectories, i.e. `<local_store_path>/<md5(name)[:2]>/<name>`.
+
+    A slice is written to a temp file and renamed once complete, so readers
+    never see partial slices. Names are kept in a sorted in-memory index,
+    which is refreshed when a lookup finds nothing newer, listing only the
+    subdirectories modified since.
+
+    Slices of `source` are kept under `<local_store_path>/source.<source>`.
+
+    Dump filter specs are kept in a `filters` file of `[[name, spec], ...]`,
+    each applying to slices from `name` on.
+    """
+
+    tmp_suffix = '.tmp'
+    progress_file = 'captured'
+    filters_file = 'filters'
+
+    def __init__(self, source=None):
+        self.source = source
         self.store_path = conf['local_store_path']
-    
+        if source is not None:
+            self.store_path = os.path.join(
+                self.store_path, 'source.{}'.format(source))
+        # fsync slice files and their directory before they become visible
+        self._fsync = conf.get('local_store_fsync', True)
+
+        self._lock = threading.Lock()
+        self._keys = []
+        self._names = []
+        # per subdirectory, mtime and names as last listed
+        self._refresh_lock = threading.Lock()
+        self._dir_mtimes = {}
+        self._dir_names = {}
+        self._refresh()
+
+        # last capture progress written by this instance
+        self._marked_ts = None
+
+        # contents of the filters file, reloaded when modified
+        self._filters = []
+        self._filters_mtime = None
+
+        self._pending_purged = False
+
+        # notified of new files by watchdog, if installed
+        self._watch = conf.get('local_store_watch', True) and \
+            Observer is not None
+        self._observer = None
+        self._saved = threading.Event()
+
+    @staticmethod
+    def _key(name):
+        ts = slice_name_to_ts(name)
+        return ts.time, ts.inc
+
+    def _path(self, name):
+        subdir = hashlib.md5(name.encode()).hexdigest()[:2]
+        return os.path.join(self.store_path, subdir, name)
+
+    def _index_add(self, name):
+        # with the lock held
+        key = self._key(name)
+        i = bisect.bisect_left(self._keys, key)
+        if i == len(self._names) or self._names[i] != name:
+            self._keys.insert(i, key)
+            self._names.insert(i, name)
+
+    def _index_remove(self, name):
+        # with the lock held
+        i = bisect.bisect_left(self._keys, self._key(name))
+        if i < len(self._names) and self._names[i] == name:
+            del self._names[i]
+            del self._keys[i]
+
+    def _refresh(self):
+        with self._refresh_lock:
+            try:
+                subdirs = os.listdir(self.store_path)
+            except FileNotFoundError:
+                subdirs = []
+
+            added = set()
+            removed = set()
+            listed = set()
+            now = time.time_ns()
+            for subdir in subdirs:
+                # skips source directories and the progress file
+                if len(subdir) != 2:
+                    continue
+                path = os.path.join(self.store_path, subdir)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    continue
+                listed.add(subdir)
+                if self._dir_mtimes.get(subdir) == st.st_mtime_ns:
+                    continue
+                names = set(n for n in os.listdir(path)
+                            if not n.endswith(self.tmp_suffix))
+                old_names = self._dir_names.get(subdir, set())
+                added |= names - old_names
+                removed |= old_names - names
+                self._dir_names[subdir] = names
+                # modified again within the mtime granularity would go
+                # unnoticed, listed again next time
+                self._dir_mtimes[subdir] = (
+                    st.st_mtime_ns if now - st.st_mtime_ns > 1e9 else None)
+
+            for subdir in set(self._dir_names) - listed:
+                removed |= self._dir_names.pop(subdir)
+                self._dir_mtimes.pop(subdir, None)
+
+            if not added and not removed:
+                return
+            with self._lock:
+                if len(added) + len(removed) > 64:
+                    names = (set(self._names) - removed) | added
+                    self._names = sorted(names, key=self._key)
+                    self._keys = [self._key(n) for n in self._names]
+                else:
+                    for name in removed:
+                        self._index_remove(name)
+                    for name in added:
+                        self._index_add(name)
+
     def list_names(self):
-        return sorted(os.listdir(self.store_path))
+        # slices may be written by another process, e.g. retention runs
+        # on its own instance
+        self._refresh()
+        with self._lock:
+            return list(self._names)
 
     def remove(self, slice_name):
-        raise NotImplementedError
+        try:
+            os.remove(self._path(slice_name))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._index_remove(slice_name)
+
+    def list_oldest(self, limit):
+        return [(name, os.path.getsize(self._path(name)))
+                for name in self.list_names()[:limit]]
+
+    def total_bytes(self):
+        return sum(os.path.getsize(self._path(name))
+                   for name in self.list_names())
 
     def get_last_saved_ts(self):
 
@@ -115,33 +697,257 @@ class LocalOplogStore(OplogStore):
             return Timestamp(
                 int(datetime.datetime(1970, 1, 2).timestamp()), 0)
 
-        last_slice = max(slices)
-        time, inc = last_slice.split('_')
-        last_ts = Timestamp(int(time), int(inc))
+        return slice_name_to_ts(slices[-1])
+
+    def mark_captured(self, ts):
+        if self._marked_ts is not None and ts <= self._marked_ts:
+            return
+        os.makedirs(self.store_path, exist_ok=True)
+        path = os.path.join(self.store_path, self.progress_file)
+        with open(path + self.tmp_suffix, 'w') as f:
+            f.write(ts_to_slice_name(ts))
+        os.replace(path + self.tmp_suffix, path)
+        self._marked_ts = ts
+
+    def captured_ts(self):
+        # the index may lag behind slices of another process, which only
+        # makes the result conservative; lookups of slices refresh it
+        with self._lock:
+            last_key = self._keys[-1] if self._keys else None
+        if last_key is None:
+            last_ts = Timestamp(
+                int(datetime.datetime(1970, 1, 2).timestamp()), 0)
+        else:
+            last_ts = Timestamp(*last_key)
+        path = os.path.join(self.store_path, self.progress_file)
+        try:
+            with open(path, 'r') as f:
+                ts = slice_name_to_ts(f.read())
+        except FileNotFoundError:
+            return last_ts
+        return max(ts, last_ts)
+
+    def _load_filters(self):
+        path = os.path.join(self.store_path, self.filters_file)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if mtime == self._filters_mtime:
+                return self._filters
+        with open(path, 'r') as f:
+            filters = json.load(f)
+        with self._lock:
+            self._filters = filters
+            self._filters_mtime = mtime
+        return filters
+
+    def _record_filter(self, name):
+        # only when it changes, before the first slice written with it
+        filters = self._load_filters()
+        last_spec = filters[-1][1] if filters else None
+        if self.dump_filter == last_spec:
+            return
+        filters = filters + [[name, self.dump_filter]]
+        os.makedirs(self.store_path, exist_ok=True)
+        path = os.path.join(self.store_path, self.filters_file)
+        with open(path + self.tmp_suffix, 'w') as f:
+            json.dump(filters, f)
+        os.replace(path + self.tmp_suffix, path)
+
+    def slice_filter(self, slice_name):
+        key = self._key(slice_name)
+        spec = None
+        for name, _spec in self._load_filters():
+            if self._key(name) > key:
+                break
+            spec = _spec
+        return spec
+
+    def _find_next(self, last_ts):
+        with self._lock:
+            i = bisect.bisect_right(self._keys, (last_ts.time, last_ts.inc))
+            if i < len(self._names):
+                return self._names[i]
+        return None
+
+    def next_slice_name(self, last_ts):
+        name = self._find_next(last_ts)
+        if name is None:
+            # may have been written by another process
+            self._refresh()
+            name = self._find_next(last_ts)
+        return name
+
+    def _start_observer(self):
+        with self._lock:
+            if self._observer is not None:
+                return
+            os.makedirs(self.store_path, exist_ok=True)
+            observer = Observer()
+            observer.schedule(_SliceEventHandler(self._saved, self.tmp_suffix),
+                              self.store_path, recursive=True)
+            observer.daemon = True
+            observer.start()
+            self._observer = observer
+        LOG.info('Watching {} for new slices'.format(self.store_path))
+
+    def wait_for_slice(self, after_ts, timeout):
+        """
+        Wait for file system events, rechecking every
+        `slice_poll_max_interval` seconds in case a notification is missed,
+        e.g. on network file systems, and polling if watchdog is missing
+        """
+        if not self._watch:
+            return super().wait_for_slice(after_ts, timeout)
+        self._start_observer()
+
+        deadline = time.time() + timeout
+        while True:
+            # cleared before checking, not to miss a slice saved in between
+            self._saved.clear()
+            if self.next_slice_name(after_ts) is not None:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._saved.wait(min(remaining, slice_poll_max_interval))
+
+    def close(self):
+        with self._lock:
+            observer, self._observer = self._observer, None
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+    def fetch(self, slice_name):
+        with open(self._path(slice_name), 'rb') as f:
+            # decompressed straight from the page cache
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def stream(self, slice_name):
+        with open(self._path(slice_name), 'rb') as f:
+            yield from serializer.iter_entries(f, allow_pickle=allow_pickle)
+
+    @timeit('upload')
+    def put_slice(self, last_ts, data, start_ts, count):
+
+        SLICE_BYTES.inc(len(data), kind='compressed')
+        name = ts_to_slice_name(last_ts)
+        path = self._path(name)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+
+        tmp_path = path + self.tmp_suffix
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._publish(tmp_path, name)
+
+    def _publish(self, tmp_path, name):
+        self._record_filter(name)
+
+        path = self._path(name)
+        os.replace(tmp_path, path)
+
+        if self._fsync:
+            fd = os.open(os.path.dirname(path), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        with self._lock:
+            self._index_add(name)
+
+    def _purge_pending(self):
+        # streamed slices left by a dump that died before renaming them,
+        # named `<ObjectId>.tmp` at the store root
+        try:
+            names = os.listdir(self.store_path)
+        except FileNotFoundError:
+            return
+        stale = [n for n in names if n.endswith(self.tmp_suffix) and
+                 ObjectId.is_valid(n[:-len(self.tmp_suffix)])]
+        for name in stale:
+            try:
+                os.remove(os.path.join(self.store_path, name))
+            except FileNotFoundError:
+                pass
+        if stale:
+            LOG.warning('Removed {} stale pending slices'.format(len(stale)))
+
+    def open_slice_writer(self):
+        if slice_format != 'raw_bson':
+            return None
+        if not self._pending_purged:
+            # slices of a source are only streamed by its one dump
+            self._purge_pending()
+            self._pending_purged = True
+        return LocalSliceWriter(self)
+
+
+class _SliceEventHandler(FileSystemEventHandler):
+    """
+    Set `saved` when a slice file appears, renamed from its temp file
+    """
 
-        return last_ts
+    def __init__(self, saved, tmp_suffix):
+        self._saved = saved
+        self._tmp_suffix = tmp_suffix
 
-    def load_oplog(self, last_ts):
+    def _notify(self, path):
+        if not path.endswith(self._tmp_suffix):
+            self._saved.set()
 
-        last_name = ts_to_slice_name(last_ts)
-        names = self.list_names()
-        cur_name = None
+    def on_created(self, event):
+        if not event.is_directory:
+            self._notify(event.src_path)
 
-        for n in names:
-            if n > last_name:
-                cur_name = n
-                break
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._notify(event.dest_path)
 
-        if cur_name is None:
-            cur_slice = None
-        else:
-            with open(os.path.join(self.store_path, last_name)) as f:
-                cur_slice = pickle.load(f)
 
-        return cur_slice
+class LocalSliceWriter(SliceWriter):
+    """
+    Stream a raw BSON slice into a temp file, renamed on commit
+    """
 
-    def dump_oplog(self, last_ts, oplog):
-        raise NotImplementedError
+    def __init__(self, oplog_store):
+        super().__init__()
+        self._oplog_store = oplog_store
+        os.makedirs(oplog_store.store_path, exist_ok=True)
+        self._tmp_path = os.path.join(
+            oplog_store.store_path,
+            '{}{}'.format(ObjectId(), oplog_store.tmp_suffix))
+        self._f = open(self._tmp_path, 'wb')
+        self._writer = RawBSONWriter(self._f, slice_codec)
+
+    def write(self, entry):
+        self._writer.write(entry)
+        self._track(entry)
+
+    def commit(self):
+        self._writer.close()
+        if self._oplog_store._fsync:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        self._f.close()
+
+        name = ts_to_slice_name(self.last_ts)
+        path = self._oplog_store._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._oplog_store._publish(self._tmp_path, name)
+        SLICE_BYTES.inc(os.path.getsize(path), kind='compressed')
+
+    def abort(self):
+        self._f.close()
+        os.remove(self._tmp_path)
 
 
 store_type = conf['oplog_store_type']
@@ -3,21 +3,73 @@
 import time
 import datetime
 import functools
+import contextlib
+import threading
+import collections
 import re
+import logging
 
+import bson
 from pymongo import IndexModel
 from bson import Timestamp
 
+from mongo_sync.metrics import STAGE_SECONDS
 
-def timeit(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
+LOG = logging.getLogger('utils')
+
+
+def timeit(stage=None):
+    """
+    Record call latency in the stage latency histogram, under `stage` or
+    the function name if used bare
+    """
+    if callable(stage):
+        return timeit()(stage)
+
+    def decorator(func):
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0_ = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.time() - t0_, stage=name)
+        return wrapper
+    return decorator
+
+
+class StageTimer(object):
+    """
+    Accumulate wall time spent in named stages, e.g. fetch/decode/apply,
+    which is also recorded in the stage latency histogram
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def time(self, stage):
         t0_ = time.time()
-        ret = func(*args, **kwargs)
-        print('%s in %.6f secs' % (
-            func.__name__, time.time() - t0_))
-        return ret
-    return wrapper
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - t0_)
+
+    def observe(self, stage, elapsed):
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0) + elapsed
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return ', '.join(
+                '{}={:.3f}s/{}'.format(stage, total, self.counts[stage])
+                for stage, total in self.totals.items())
 
 
 def ts_to_slice_name(ts):
@@ -30,6 +82,21 @@ def slice_name_to_ts(name):
     return ts
 
 
+def get_doc_id(entry):
+    """Get `_id` of the document an oplog entry applies to."""
+    if entry['op'] == 'u':
+        return entry['o2']['_id']
+    return entry['o']['_id']
+
+
+def entry_size(entry):
+    """Get BSON size of an oplog entry, raw documents are not re-encoded."""
+    raw = getattr(entry, 'raw', None)
+    if raw is not None:
+        return len(raw)
+    return len(bson.encode(entry))
+
+
 def dt2ts(dt):
     return Timestamp(int(dt.timestamp()), 0)
 
@@ -64,14 +131,15 @@ def copy_index(src_coll, dst_coll):
         if ind_name == '_id_':
             continue
         ind = ind_settings[ind_name]
-        print(ind)
+        LOG.debug('Copying index {} of {}: {}'.format(
+            ind_name, src_coll.full_name, ind))
         
         keys = [(e[0], _to_legal_ind_direction(e[1])) for e in ind['key']]
+        # unique, sparse, expireAfterSeconds, partialFilterExpression, ...
+        options = {k: v for k, v in ind.items()
+                   if k not in ('key', 'v', 'ns')}
 
-        models.append(IndexModel(
-            keys,
-            unique=ind.get('unique', False),
-            background=ind.get('background', False)))
+        models.append(IndexModel(keys, name=ind_name, **options))
 
     if len(models) > 0:
         dst_coll.create_indexes(models)
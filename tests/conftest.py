@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+import yaml
+
+# `mongo_sync` reads its config on import, point it to a local store
+_workdir = tempfile.mkdtemp(prefix='mongo_sync_tests_')
+_conf = {
+    'src_url': '',
+    'dst_url': '',
+    'oplog_store_type': 'LocalOplogStore',
+    'oplog_store_url': '',
+    'oplog_store_db': '__oplog_store',
+    'local_store_path': os.path.join(_workdir, 'store'),
+    'local_store_fsync': False,
+    'local_store_watch': False,
+    'slice_format': 'raw_bson',
+    'whitelist': [],
+    'blacklist': [],
+    'keep_days': 7,
+    'logging': {'version': 1, 'disable_existing_loggers': False},
+    'email': {'smtp_mail_from': '', 'smtp_host': '', 'smtp_port': '25',
+              'smtp_starttls': False, 'smtp_ssl': False, 'smtp_user': '',
+              'smtp_password': '', 'smtp_mail_to': ''},
+}
+_path = os.path.join(_workdir, 'test_config.yaml')
+with open(_path, 'w') as f:
+    yaml.safe_dump(_conf, f)
+os.environ.setdefault('MONGOSYNC_CONF', _path)
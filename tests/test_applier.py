@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+import pytest
+from bson import Timestamp
+
+from mongo_sync.oplog_replay import PartitionedApplier
+
+
+class RecordingDocManager(object):
+
+    def __init__(self, applied, lock, fail_on=None):
+        self.applied = applied
+        self._lock = lock
+        self._fail_on = fail_on
+        self.num_requests = 0
+        self.num_round_trips = 0
+
+    def process(self, entry):
+        if entry['ts'].time == self._fail_on:
+            raise ValueError('failed on {}'.format(self._fail_on))
+        # let other workers interleave
+        time.sleep(0.0005)
+        with self._lock:
+            self.applied.append(entry)
+
+    def flush(self):
+        pass
+
+
+def _applier(num_workers=4, fail_on=None):
+    applied = []
+    lock = threading.Lock()
+    applier = PartitionedApplier(
+        num_workers, lambda: RecordingDocManager(applied, lock, fail_on))
+    return applied, applier
+
+
+def _write(seq, _id, ns='db.a'):
+    return {'ts': Timestamp(seq, 0), 'op': 'u', 'ns': ns,
+            'o': {'$set': {'seq': seq}}, 'o2': {'_id': _id}}
+
+
+def _command(seq):
+    return {'ts': Timestamp(seq, 0), 'op': 'c', 'ns': 'db.$cmd',
+            'o': {'drop': 'b'}}
+
+
+def test_per_document_order_kept():
+    applied, applier = _applier()
+    entries = [_write(seq, seq % 7, ns='db.{}'.format(seq % 2))
+               for seq in range(200)]
+    for entry in entries:
+        applier.process(entry)
+    applier.flush()
+    applier.close()
+
+    assert len(applied) == len(entries)
+
+    def per_doc(oplog):
+        docs = {}
+        for entry in oplog:
+            key = entry['ns'], entry['o2']['_id']
+            docs.setdefault(key, []).append(entry['o']['$set']['seq'])
+        return docs
+
+    assert per_doc(applied) == per_doc(entries)
+
+
+def test_workers_drained_before_command():
+    applied, applier = _applier()
+    for seq in range(50):
+        applier.process(_write(seq, seq))
+    applier.process(_command(50))
+    applier.process(_write(51, 1))
+    applier.flush()
+    applier.close()
+
+    seqs = [e['ts'].time for e in applied]
+    assert sorted(seqs[:50]) == list(range(50))
+    assert seqs[50:] == [50, 51]
+
+
+def test_worker_error_raised():
+    applied, applier = _applier(fail_on=3)
+    for seq in range(10):
+        applier.process(_write(seq, seq))
+    with pytest.raises(Exception, match='failed on 3'):
+        applier.flush()
+    with pytest.raises(Exception, match='Parallel replay failed'):
+        applier.process(_write(10, 10))
+    applier.close()
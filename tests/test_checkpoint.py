@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+
+import pytest
+from bson import Timestamp
+
+from benchmarks.fake_mongo import FakeClient
+from mongo_sync.checkpoint import FileCheckpoint
+from mongo_sync.oplog_replay import OplogReplay, BulkDocManager
+from mongo_sync.config import conf
+
+
+def test_file_checkpoint_round_trip(tmp_path):
+    checkpoint = FileCheckpoint(str(tmp_path / 'tag'))
+    assert checkpoint.read() is None
+    checkpoint.write(Timestamp(100, 3))
+    assert checkpoint.read() == Timestamp(100, 3)
+    assert os.listdir(tmp_path) == ['tag']
+
+
+def test_file_checkpoint_kept_if_write_interrupted(tmp_path, monkeypatch):
+    checkpoint = FileCheckpoint(str(tmp_path / 'tag'))
+    checkpoint.write(Timestamp(100, 3))
+
+    def crash(src, dst):
+        raise OSError('crashed')
+
+    monkeypatch.setattr(os, 'replace', crash)
+    with pytest.raises(OSError):
+        checkpoint.write(Timestamp(200, 0))
+    assert checkpoint.read() == Timestamp(100, 3)
+
+
+def test_legacy_crash_tag_refused(tmp_path, monkeypatch):
+    path = tmp_path / 'tag'
+    path.write_text('-1')
+    monkeypatch.setitem(conf, 'checkpoint_path', str(path))
+    monkeypatch.setitem(conf, 'replay_start_time',
+                        datetime.datetime(1970, 1, 2))
+    with pytest.raises(Exception, match='legacy tag'):
+        OplogReplay()
+
+
+class CrashingDocManager(BulkDocManager):
+
+    crash_at = None
+
+    def process(self, entry):
+        if entry['ts'].time == self.crash_at:
+            raise RuntimeError('crashed')
+        super().process(entry)
+
+
+def test_resume_mid_slice(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf, 'checkpoint_path', str(tmp_path / 'tag'))
+    monkeypatch.setitem(conf, 'replay_start_time',
+                        datetime.datetime(1970, 1, 2))
+    monkeypatch.setitem(conf, 'checkpoint_every_entries', 4)
+    monkeypatch.setitem(conf, 'checkpoint_every_seconds', 3600)
+
+    client = FakeClient(rtt=0, record=True)
+    monkeypatch.setattr(OplogReplay, 'make_docman', lambda self:
+                        CrashingDocManager(client=client, batch_size=100))
+
+    start = 86400
+    oplog = [{'ts': Timestamp(start + i, 0), 'op': 'i', 'ns': 'db.a',
+              'o': {'_id': i}} for i in range(1, 11)]
+
+    op = OplogReplay()
+    op.docman.crash_at = start + 7
+    with pytest.raises(RuntimeError):
+        op.replay(op._skip_replayed(oplog))
+    # checkpointed after entries 4, applied once flushed
+    assert op.read_tag_file() == Timestamp(start + 4, 0)
+
+    del client.calls[:]
+    op = OplogReplay()
+    assert op.last_ts == Timestamp(start + 4, 0)
+    op.replay(op._skip_replayed(oplog))
+    assert op.read_tag_file() == Timestamp(start + 10, 0)
+    assert [req._filter['_id'] for call in client.calls
+            for req in call[2]] == list(range(5, 11))
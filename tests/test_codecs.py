@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+
+import bson
+import pytest
+from bson import Timestamp
+
+from mongo_sync import codecs
+from mongo_sync.mongo_store import RawBSONWriter, RawBSONSerializer
+
+PAYLOAD = b''.join(
+    b'{"op": "u", "ns": "db.coll", "o": {"$set": {"n": %d}}}' % i
+    for i in range(5000)) + os.urandom(1000)
+
+
+def all_codecs():
+    ret = [codecs.get_codec('lz4-block'), codecs.get_codec('lz4-frame')]
+    if codecs.zstandard is not None:
+        ret.append(codecs.get_codec('zstd'))
+        samples = [PAYLOAD[i:i + 512] for i in range(0, len(PAYLOAD), 512)]
+        data = codecs.train_dictionary(samples, dict_size=4096)
+        dict_id = codecs.zstandard.ZstdCompressionDict(data).dict_id()
+        codecs._dictionaries[dict_id] = data
+        ret.append(codecs.get_codec('zstd-dict:{}'.format(dict_id)))
+    return ret
+
+
+@pytest.fixture(params=all_codecs(), ids=lambda codec: codec.id)
+def codec(request):
+    return request.param
+
+
+def _stream_compress(codec, data, chunk_size):
+    compressor = codec.compressor()
+    out = [compressor.compress(data[i:i + chunk_size])
+           for i in range(0, len(data), chunk_size)]
+    out.append(compressor.flush())
+    return b''.join(out)
+
+
+def _stream_decompress(codec, data, chunk_size):
+    decompressor = codec.decompressor()
+    out = [decompressor.decompress(data[i:i + chunk_size])
+           for i in range(0, len(data), chunk_size)]
+    out.append(decompressor.flush())
+    return b''.join(out)
+
+
+def test_round_trip(codec):
+    assert codec.decompress(codec.compress(PAYLOAD)) == PAYLOAD
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 65536])
+def test_stream_round_trip(codec, chunk_size):
+    data = _stream_compress(codec, PAYLOAD[:20000], chunk_size)
+    assert codec.decompress(data) == PAYLOAD[:20000]
+    assert _stream_decompress(codec, data, chunk_size) == PAYLOAD[:20000]
+
+
+def test_stream_empty(codec):
+    data = _stream_compress(codec, b'', 1)
+    assert _stream_decompress(codec, data, 1) == b''
+
+
+def test_stream_flush_only(codec):
+    compressor = codec.compressor()
+    assert codec.decompress(compressor.flush()) == b''
+
+
+def test_unknown_codec():
+    with pytest.raises(Exception):
+        codecs.get_codec('snappy')
+
+
+def _decoded(docs):
+    return [bson.decode(doc.raw) for doc in docs]
+
+
+def test_raw_bson_writer(codec):
+    entries = [{'ts': Timestamp(1, i), 'op': 'i', 'ns': 'db.coll',
+                'o': {'_id': i}} for i in range(100)]
+    f = io.BytesIO()
+    writer = RawBSONWriter(f, codec)
+    for entry in entries:
+        writer.write(entry)
+    writer.close()
+
+    data = f.getvalue()
+    assert _decoded(RawBSONSerializer.deserialize(data)) == entries
+
+    f = io.BytesIO(data)
+    f.read(len(RawBSONSerializer.MAGIC))
+    assert _decoded(RawBSONSerializer.iter_stream(f, 64)) == entries
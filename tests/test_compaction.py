@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+from bson import Timestamp
+
+from benchmarks.fake_mongo import FakeClient
+from mongo_sync.compaction import compact, UniqueIndexes
+
+
+def _op(t, op, o, ns='db.coll', _id=None):
+    entry = {'ts': Timestamp(t, 0), 'op': op, 'ns': ns, 'o': o}
+    if op == 'u':
+        entry['o2'] = {'_id': _id}
+    return entry
+
+
+def test_insert_folds_updates():
+    out = compact([
+        _op(1, 'i', {'_id': 1, 'a': 1}),
+        _op(2, 'u', {'$set': {'b': 2}}, _id=1),
+        _op(3, 'u', {'$unset': {'a': True}}, _id=1),
+    ])
+    assert out == [_op(3, 'i', {'_id': 1, 'b': 2})]
+
+
+def test_delete_wins():
+    out = compact([
+        _op(1, 'i', {'_id': 1}),
+        _op(2, 'u', {'$set': {'b': 2}}, _id=1),
+        _op(3, 'd', {'_id': 1}),
+    ])
+    assert out == [_op(3, 'd', {'_id': 1})]
+
+
+def test_updates_merge():
+    out = compact([
+        _op(1, 'u', {'$set': {'a': 1}}, _id=1),
+        _op(2, 'u', {'$set': {'b': 2}, '$unset': {'c': True}}, _id=1),
+    ])
+    assert out == [_op(2, 'u', {'$set': {'a': 1, 'b': 2},
+                                '$unset': {'c': True}}, _id=1)]
+
+
+def test_overlapping_paths_not_merged():
+    oplog = [
+        _op(1, 'u', {'$set': {'a': {'x': 1}}}, _id=1),
+        _op(2, 'u', {'$set': {'a.y': 2}}, _id=1),
+    ]
+    assert compact(oplog) == oplog
+
+
+def test_command_is_barrier():
+    oplog = [
+        _op(1, 'u', {'$set': {'a': 1}}, _id=1),
+        _op(2, 'c', {'drop': 'other'}, ns='db.$cmd'),
+        _op(3, 'u', {'$set': {'b': 2}}, _id=1),
+    ]
+    assert compact(oplog) == oplog
+
+
+def test_other_document_of_ns_is_barrier():
+    # a unique value moved from document 1 to 2 and back
+    oplog = [
+        _op(1, 'u', {'$set': {'k': 'x'}}, _id=1),
+        _op(2, 'u', {'$unset': {'k': True}}, _id=1),
+        _op(3, 'u', {'$set': {'k': 'x'}}, _id=2),
+        _op(4, 'u', {'$unset': {'k': True}}, _id=2),
+        _op(5, 'u', {'$set': {'k': 'x'}}, _id=1),
+    ]
+    out = compact(oplog)
+    assert [e['ts'].time for e in out] == [2, 4, 5]
+    assert out[0]['o'] == {'$unset': {'k': True}}
+
+
+def test_other_ns_is_not_barrier():
+    out = compact([
+        _op(1, 'u', {'$set': {'a': 1}}, _id=1),
+        _op(2, 'i', {'_id': 1}, ns='db.other'),
+        _op(3, 'u', {'$set': {'b': 2}}, _id=1),
+    ])
+    assert out == [_op(2, 'i', {'_id': 1}, ns='db.other'),
+                   _op(3, 'u', {'$set': {'a': 1, 'b': 2}}, _id=1)]
+
+
+def _unique_indexes(*namespaces):
+    client = FakeClient(rtt=0, record=True)
+    for ns in namespaces:
+        client.indexes[ns] = {'k_1': {'key': [('k', 1)], 'unique': True}}
+    return client, UniqueIndexes(client)
+
+
+MOVED_VALUE = [
+    _op(1, 'u', {'$set': {'k': 'x'}}, _id=1),
+    _op(2, 'u', {'$unset': {'k': True}}, _id=1),
+    _op(3, 'u', {'$set': {'k': 'x'}}, _id=2),
+    _op(4, 'u', {'$unset': {'k': True}}, _id=2),
+    _op(5, 'u', {'$set': {'k': 'x'}}, _id=1),
+]
+
+
+def test_other_document_is_barrier_with_unique_index():
+    client, unique_indexes = _unique_indexes('db.coll')
+    out = compact(MOVED_VALUE, unique_indexes)
+    assert [e['ts'].time for e in out] == [2, 4, 5]
+    out = compact(MOVED_VALUE, unique_indexes)
+    assert len(client.calls) == 1
+
+
+def test_other_document_is_not_barrier_without_unique_index():
+    client, unique_indexes = _unique_indexes('db.other')
+    out = compact(MOVED_VALUE, unique_indexes)
+    assert [e['ts'].time for e in out] == [4, 5]
+    assert out[1]['o'] == {'$set': {'k': 'x'}}
+
+
+def test_command_forgets_indexes_of_its_db():
+    client, unique_indexes = _unique_indexes()
+    oplog = [
+        _op(1, 'u', {'$set': {'a': 1}}, _id=1),
+        _op(2, 'c', {'createIndexes': 'coll'}, ns='db.$cmd'),
+        _op(3, 'u', {'$set': {'b': 2}}, _id=1),
+        _op(4, 'u', {'$set': {'c': 3}}, _id=2),
+        _op(5, 'u', {'$set': {'d': 4}}, _id=1),
+    ]
+    # index possibly created by the command, not yet on the target
+    assert compact(oplog, unique_indexes) == oplog
+    client.indexes['db.coll'] = {'k_1': {'unique': True}}
+    assert compact(oplog[2:], unique_indexes) == oplog[2:]
+    assert len(client.calls) == 2
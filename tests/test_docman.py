@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from bson import Timestamp
+from pymongo import ReplaceOne, UpdateOne, DeleteOne
+
+from benchmarks.fake_mongo import FakeClient
+from mongo_sync.oplog_replay import BulkDocManager
+
+
+def _insert(ns, _id):
+    return {'ts': Timestamp(1, 0), 'op': 'i', 'ns': ns, 'o': {'_id': _id}}
+
+
+def _update(ns, _id, doc):
+    return {'ts': Timestamp(1, 0), 'op': 'u', 'ns': ns, 'o': doc,
+            'o2': {'_id': _id}}
+
+
+def _delete(ns, _id):
+    return {'ts': Timestamp(1, 0), 'op': 'd', 'ns': ns, 'o': {'_id': _id}}
+
+
+def _docman(**kwargs):
+    client = FakeClient(rtt=0, record=True)
+    kwargs.setdefault('flush_interval', 3600)
+    return client, BulkDocManager(client=client, **kwargs)
+
+
+def test_writes_batched_per_namespace_in_order():
+    client, docman = _docman(batch_size=100)
+    for entry in [_insert('db.a', 1), _insert('db.b', 1),
+                  _update('db.a', 1, {'$set': {'x': 1}}),
+                  _update('db.a', 1, {'x': 2}), _delete('db.a', 1)]:
+        docman.process(entry)
+    assert client.calls == []
+
+    docman.flush()
+    assert sorted(client.calls, key=lambda call: call[1]) == [
+        ('bulk_write', 'db.a', [
+            ReplaceOne({'_id': 1}, {'_id': 1}, upsert=True),
+            UpdateOne({'_id': 1}, {'$set': {'x': 1}}),
+            ReplaceOne({'_id': 1}, {'x': 2}),
+            DeleteOne({'_id': 1})]),
+        ('bulk_write', 'db.b', [
+            ReplaceOne({'_id': 1}, {'_id': 1}, upsert=True)])]
+    assert (docman.num_requests, docman.num_round_trips) == (5, 2)
+
+
+def test_full_batch_flushed():
+    client, docman = _docman(batch_size=2)
+    for _id in range(5):
+        docman.process(_insert('db.a', _id))
+    assert [len(call[2]) for call in client.calls] == [2, 2]
+    docman.flush()
+    assert [len(call[2]) for call in client.calls] == [2, 2, 1]
+
+
+def test_command_is_barrier():
+    client, docman = _docman(batch_size=100)
+    docman.process(_insert('db.a', 1))
+    docman.process({'ts': Timestamp(2, 0), 'op': 'c', 'ns': 'db.$cmd',
+                    'o': {'drop': 'a'}})
+    docman.process(_insert('db.a', 2))
+    docman.flush()
+    assert [call[0] for call in client.calls] == [
+        'bulk_write', 'drop_collection', 'bulk_write']
+
+
+def test_stale_buffer_flushed_after_interval():
+    client, docman = _docman(batch_size=100, flush_interval=1e-9)
+    docman.process(_insert('db.a', 1))
+    assert [call[0] for call in client.calls] == ['bulk_write']
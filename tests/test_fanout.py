@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from bson import Timestamp
+
+from mongo_sync.fanout import SliceCache, LagWindow
+
+
+def test_slice_cache_loads_concurrent_misses_once():
+    cache = SliceCache(2)
+    loads = []
+    started = threading.Event()
+
+    def load(name):
+        loads.append(name)
+        started.set()
+        time.sleep(0.2)
+        return [name]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        cache.get('s1', load))) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == ['s1']
+    assert results == [['s1']] * 4
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_slice_cache_retries_failed_load_and_evicts_lru():
+    cache = SliceCache(2)
+
+    def fail(name):
+        raise IOError('gone')
+
+    try:
+        cache.get('s1', fail)
+    except IOError:
+        pass
+    assert cache.get('s1', lambda name: [name]) == ['s1']
+
+    cache.get('s2', lambda name: [name])
+    cache.get('s1', lambda name: [])
+    cache.get('s3', lambda name: [name])
+    # s2 least recently used
+    assert cache.get('s2', lambda name: ['reloaded']) == ['reloaded']
+
+
+class FakeReplay(object):
+
+    def __init__(self, name, last_ts):
+        self.name = name
+        self.last_ts = Timestamp(last_ts, 0)
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+def _wait_in_thread(window, op, ts):
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(window.wait(op, Timestamp(ts, 0))))
+    thread.start()
+    return thread, result
+
+
+def test_lag_window_holds_fast_replay_until_slowest_leaves():
+    window = LagWindow(60)
+    fast, slow = FakeReplay('fast', 1000), FakeReplay('slow', 100)
+    window.join(fast)
+    window.join(slow)
+
+    assert window.wait(slow, Timestamp(200, 0))
+    assert window.wait(fast, Timestamp(150, 0))
+
+    thread, result = _wait_in_thread(window, fast, 1100)
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    window.leave(slow)
+    thread.join(5)
+    assert result == [True]
+
+
+def test_lag_window_releases_on_advance_and_stop():
+    window = LagWindow(60)
+    fast, slow = FakeReplay('fast', 1000), FakeReplay('slow', 100)
+    window.join(fast)
+    window.join(slow)
+
+    thread, result = _wait_in_thread(window, fast, 1100)
+    thread.join(0.2)
+    slow.last_ts = Timestamp(1050, 0)
+    window.advance()
+    thread.join(5)
+    assert result == [True]
+
+    thread, result = _wait_in_thread(window, slow, 2000)
+    thread.join(0.2)
+    assert thread.is_alive()
+    slow.active = False
+    window.advance()
+    thread.join(5)
+    assert result == [False]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import pytest
+
+from mongo_sync import main
+from mongo_sync.config import conf
+
+
+def test_invalid_options_rejected_before_initial_sync(monkeypatch):
+    def initial_sync():
+        raise AssertionError('initial sync started')
+
+    monkeypatch.setattr(main, 'initial_sync', initial_sync)
+    monkeypatch.setitem(conf, 'targets', [{'name': 'a', 'url': 'mongodb://a'}])
+    monkeypatch.setattr(sys, 'argv', [
+        'mongo-sync', '--initial-sync', '--replay', '--engine', 'asyncio'])
+    with pytest.raises(SystemExit) as e:
+        main.main()
+    assert e.value.code == 2
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import time
+import datetime
+import threading
+
+import pytest
+from bson import Timestamp
+
+from benchmarks.fake_mongo import FakeClient
+from mongo_sync.oplog_replay import MergedOplogReplay, DocManager
+from mongo_sync.store import LocalOplogStore
+from mongo_sync.mongo_store import encode_slice
+from mongo_sync.config import conf
+
+START = 86400
+
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf, 'local_store_path', str(tmp_path / 'store'))
+    monkeypatch.setitem(conf, 'checkpoint_path', str(tmp_path / 'tag'))
+    monkeypatch.setitem(conf, 'replay_start_time',
+                        datetime.datetime.fromtimestamp(START))
+    monkeypatch.setattr(MergedOplogReplay, 'make_docman', lambda self:
+                        DocManager(client=FakeClient(rtt=0)))
+    return MergedOplogReplay([{'name': 'a'}, {'name': 'b'}])
+
+
+def _put(store, times):
+    entries = [{'ts': Timestamp(START + t, 0), 'op': 'i', 'ns': 'db.a',
+                'o': {'_id': t}} for t in times]
+    store.put_slice(entries[-1]['ts'], encode_slice('raw_bson', entries),
+                    entries[0]['ts'], len(entries))
+
+
+def _times(oplog):
+    return [entry['ts'].time - START for entry in oplog]
+
+
+def test_watermark_advances_with_idle_source_progress(replay):
+    active = LocalOplogStore(source='a')
+    idle = LocalOplogStore(source='b')
+    _put(active, [10, 20])
+    _put(active, [30, 40])
+
+    # nothing known of the idle source yet
+    assert replay.load_oplog() is None
+
+    idle.mark_captured(Timestamp(START + 25, 0))
+    assert _times(replay.load_oplog()) == [10, 20]
+    assert replay.load_oplog() is None
+
+    idle.mark_captured(Timestamp(START + 100, 0))
+    assert _times(replay.load_oplog()) == [30, 40]
+
+
+def test_wait_wakes_on_idle_source_progress(replay):
+    active = LocalOplogStore(source='a')
+    idle = LocalOplogStore(source='b')
+    _put(active, [10, 20])
+    idle.mark_captured(Timestamp(START + 15, 0))
+    assert _times(replay.load_oplog()) == [10]
+    assert replay.load_oplog() is None
+
+    timer = threading.Timer(
+        0.3, idle.mark_captured, [Timestamp(START + 30, 0)])
+    timer.start()
+    t0_ = time.time()
+    assert replay.wait_for_slice(10)
+    assert time.time() - t0_ < 5
+    assert _times(replay.load_oplog()) == [20]
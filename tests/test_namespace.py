@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from mongo_sync.namespace import NamespaceFilter
+
+
+@pytest.mark.parametrize('dump, replay, covered', [
+    ({}, {'whitelist': ['db.a']}, True),
+    ({'whitelist': ['db.a']}, {}, False),
+    ({'whitelist': ['db.a']}, {'whitelist': ['db.a']}, True),
+    ({'whitelist': ['db.*']}, {'whitelist': ['db.a', 'db.b*']}, True),
+    ({'whitelist': ['db.a', 'db.b']}, {'whitelist': ['db.a']}, True),
+    ({'whitelist': ['db.a']}, {'whitelist': ['db.a', 'db.b']}, False),
+    ({'whitelist': ['db.a*']}, {'whitelist': ['db.*']}, False),
+    ({'blacklist': ['db.a']}, {'blacklist': ['db.a', 'db.b']}, True),
+    ({'blacklist': ['db.a']}, {'blacklist': ['db.*']}, True),
+    ({'blacklist': ['db.*']}, {'blacklist': ['db.a']}, False),
+    ({'blacklist': ['db.a']}, {'whitelist': ['db.b']}, True),
+    ({'blacklist': ['db.a']}, {'whitelist': ['db.a']}, False),
+    ({'blacklist': ['db.a']}, {'whitelist': ['db.*']}, False),
+    ({'whitelist': ['db.*']}, {'blacklist': ['db.a']}, False),
+])
+def test_covers(dump, replay, covered):
+    assert NamespaceFilter(**dump).covers(NamespaceFilter(**replay)) == \
+        covered
+
+
+@pytest.mark.parametrize('ns, whitelisted, blacklisted', [
+    ('db.a', True, True),
+    ('db.b', False, False),
+    ('db.b.c', False, False),
+    ('other.b', False, True),
+    ('other.c', True, True),
+    ('db.system.indexes', False, False),
+    ('db.$cmd', True, True),
+])
+def test_should_sync(ns, whitelisted, blacklisted):
+    whitelist = ['db.a', '*.c']
+    assert NamespaceFilter(whitelist=whitelist).should_sync(ns) == \
+        whitelisted
+    blacklist = ['db.b*']
+    assert NamespaceFilter(blacklist=blacklist).should_sync(ns) == \
+        blacklisted
+
+
+def test_decisions_cached_in_bounded_lru():
+    ns_filter = NamespaceFilter(whitelist=['db.*'], cache_size=2)
+    ns_filter.should_sync('db.a')
+    ns_filter.should_sync('db.b')
+    # refreshes db.a, db.b is evicted next
+    ns_filter.should_sync('db.a')
+    ns_filter.should_sync('db.c')
+    assert list(ns_filter._cache) == ['db.a', 'db.c']
+    assert (ns_filter.hits, ns_filter.misses) == (1, 3)
+
+    ns_filter.should_sync('db.b')
+    assert (ns_filter.hits, ns_filter.misses) == (1, 4)
+
+
+def test_filtered_drop_database_drops_synced_collections_only():
+    from benchmarks.fake_mongo import FakeClient
+    from mongo_sync.oplog_replay import DocManager
+
+    client = FakeClient(rtt=0, record=True)
+    for coll in ('a', 'b', 'c'):
+        client['db'][coll].replace_one({'_id': 1}, {'_id': 1}, upsert=True)
+    del client.calls[:]
+
+    docman = DocManager(client=client)
+    docman._ns_filter = NamespaceFilter(blacklist=['db.b'])
+    docman.process({'op': 'c', 'ns': 'db.$cmd', 'o': {'dropDatabase': 1}})
+    assert client.calls == [('drop_collection', 'db.a', None),
+                            ('drop_collection', 'db.c', None)]
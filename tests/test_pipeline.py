@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from bson import Timestamp
+
+from mongo_sync.pipeline import DumpPipeline
+
+
+class RecordingStore(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def put_slice(self, last_ts, data, start_ts, count):
+        # uploads lag behind the dumping thread
+        time.sleep(0.05)
+        self.calls.append(('put', last_ts))
+
+    def mark_captured(self, ts):
+        self.calls.append(('mark', ts))
+
+
+def test_capture_progress_follows_uploads():
+    store = RecordingStore()
+    pipeline = DumpPipeline(store, 'raw_bson')
+    for i in range(1, 4):
+        pipeline.submit([{'ts': Timestamp(i, 0), 'op': 'i', 'ns': 'db.c',
+                          'o': {'_id': i}}])
+    pipeline.mark_captured(Timestamp(10, 0))
+    pipeline.close()
+
+    assert store.calls == [
+        ('put', Timestamp(1, 0)),
+        ('put', Timestamp(2, 0)),
+        ('put', Timestamp(3, 0)),
+        ('mark', Timestamp(10, 0)),
+    ]
+
+
+def test_prefetch_bounded_by_decoded_size(tmp_path, monkeypatch):
+    from mongo_sync.pipeline import SlicePrefetcher
+    from mongo_sync.store import LocalOplogStore
+    from mongo_sync.mongo_store import encode_slice
+    from mongo_sync.config import conf
+
+    monkeypatch.setitem(conf, 'local_store_path', str(tmp_path))
+    store = LocalOplogStore()
+    sizes = []
+    for s in range(3):
+        entries = [{'ts': Timestamp(100 * s + i, 1), 'op': 'i', 'ns': 'db.c',
+                    'o': {'_id': i, 'pad': 'x' * 1000}} for i in range(1, 51)]
+        data = encode_slice('raw_bson', entries)
+        sizes.append(len(data))
+        store.put_slice(entries[-1]['ts'], data, entries[0]['ts'], 50)
+
+    # room for every compressed slice, not for two decoded ones
+    prefetcher = SlicePrefetcher(store, Timestamp(0, 0), depth=3,
+                                 max_bytes=sum(sizes) * 2)
+    prefetcher.start()
+    try:
+        name, oplog = prefetcher.get(timeout=5)
+        assert len(oplog) == 50
+        time.sleep(0.2)
+        assert len(prefetcher._queue) == 1
+    finally:
+        prefetcher.stop()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+from bson import Timestamp
+
+from mongo_sync.store import LocalOplogStore
+from mongo_sync.mongo_store import encode_slice
+from mongo_sync.config import conf
+
+
+def _entries(start, count):
+    return [{'ts': Timestamp(start + i, 0), 'op': 'i', 'ns': 'db.coll',
+             'o': {'_id': start + i}} for i in range(count)]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf, 'local_store_path', str(tmp_path))
+    return LocalOplogStore()
+
+
+def _put(store, entries):
+    store.put_slice(entries[-1]['ts'], encode_slice('raw_bson', entries),
+                    entries[0]['ts'], len(entries))
+
+
+def test_captured_ts_without_rescan(store, monkeypatch):
+    _put(store, _entries(100, 3))
+    assert store.captured_ts() == Timestamp(102, 0)
+
+    store.mark_captured(Timestamp(200, 0))
+    store.mark_captured(Timestamp(150, 0))
+    assert store.captured_ts() == Timestamp(200, 0)
+
+    def rescan():
+        raise AssertionError('rescanned')
+
+    monkeypatch.setattr(store, '_refresh', rescan)
+    store.mark_captured(Timestamp(300, 0))
+    assert store.captured_ts() == Timestamp(300, 0)
+    assert not any(n.endswith(store.tmp_suffix)
+                   for n in os.listdir(store.store_path))
+
+
+def test_retention_sees_slices_of_other_instances(store):
+    from mongo_sync.retention import RetentionWorker
+
+    worker = RetentionWorker(LocalOplogStore())
+    for i in range(3):
+        _put(store, _entries(100 + 10 * i, 2))
+
+    assert worker._oplog_store.list_expired(Timestamp(120, 0)) == \
+        ['101_0', '111_0']
+    assert worker._oplog_store.total_bytes() > 0
+    assert [name for name, _ in worker._oplog_store.list_oldest(1)] == \
+        ['101_0']
+
+
+def test_slice_filter_recorded_on_change(store):
+    _put(store, _entries(100, 3))
+    spec = {'whitelist': ['db.*'], 'blacklist': []}
+    store.dump_filter = spec
+    _put(store, _entries(110, 3))
+    _put(store, _entries(120, 3))
+    store.dump_filter = None
+    _put(store, _entries(130, 3))
+
+    other = LocalOplogStore()
+    assert other.slice_filter('102_0') is None
+    assert other.slice_filter('112_0') == spec
+    assert other.slice_filter('122_0') == spec
+    assert other.slice_filter('132_0') is None
+
+
+def test_refresh_lists_modified_subdirectories_only(store, monkeypatch):
+    for i in range(5):
+        _put(store, _entries(100 + 10 * i, 2))
+    # older than the mtime granularity
+    for subdir in os.listdir(store.store_path):
+        path = os.path.join(store.store_path, subdir)
+        if os.path.isdir(path):
+            os.utime(path, ns=(0, 0))
+
+    other = LocalOplogStore()
+    assert other.list_names() == ['101_0', '111_0', '121_0', '131_0', '141_0']
+
+    listed = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        listed.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(os, 'listdir', counting_listdir)
+    assert other.next_slice_name(Timestamp(141, 0)) is None
+    assert listed == [other.store_path]
+
+    _put(store, _entries(150, 2))
+    store.remove('101_0')
+    assert other.next_slice_name(Timestamp(141, 0)) == '151_0'
+    assert other.list_names() == ['111_0', '121_0', '131_0', '141_0', '151_0']
+
+
+def test_stale_pending_slices_purged(store, monkeypatch):
+    monkeypatch.setattr('mongo_sync.store.slice_format', 'raw_bson')
+    writer = store.open_slice_writer()
+    for entry in _entries(100, 2):
+        writer.write(entry)
+    # the dump dies before committing
+    writer._f.close()
+
+    restarted = LocalOplogStore()
+    writer = restarted.open_slice_writer()
+    assert [n for n in os.listdir(store.store_path)
+            if n.endswith(store.tmp_suffix)] == [
+                os.path.basename(writer._tmp_path)]
+    for entry in _entries(110, 2):
+        writer.write(entry)
+    writer.commit()
+    assert restarted.list_names() == ['111_0']
+
+
+def test_backfilled_manifest_sizes_slices():
+    from mongo_sync.store import MongoOplogStore
+
+    class Files(object):
+        def find(self, query, projection):
+            return [{'filename': '101_0', 'length': 10},
+                    {'filename': 'pending.5f0000000000000000000000',
+                     'length': 3},
+                    {'filename': '111_0', 'length': 20}]
+
+    class Store(object):
+        collection = 'fs'
+        db = {'fs.files': Files()}
+
+    class Manifest(object):
+        def __init__(self):
+            self.docs = {}
+
+        def replace_one(self, query, doc, upsert=False):
+            self.docs[query['_id']] = doc
+
+    manifest = Manifest()
+    MongoOplogStore()._backfill_manifest(Store(), manifest)
+    assert manifest.docs == {
+        '101_0': {'end_ts': Timestamp(101, 0), 'bytes': 10},
+        '111_0': {'end_ts': Timestamp(111, 0), 'bytes': 20}}
+
+
+@pytest.mark.parametrize('max_bytes, sized', [(0, False), (1 << 20, True)])
+def test_decoded_entries_sized_for_byte_limit_only(monkeypatch, max_bytes,
+                                                   sized):
+    from mongo_sync.store import SliceWriter
+
+    monkeypatch.setattr('mongo_sync.store.slice_max_bytes', max_bytes)
+    writer = SliceWriter()
+    for entry in _entries(100, 3):
+        writer.write(entry)
+    assert writer.count == 3
+    assert (writer.num_bytes > 0) == sized